@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+#
+# Igor Serebryany
+
+"""asyncio front end for the snippet highlighter
+
+Highlighting is pure python and can take a while on long documents, so calling
+snippets.highlightDoc from a coroutine would block the event loop. These run it
+in an executor instead. Requires python 3.7 or later."""
+import asyncio, concurrent.futures, functools
+
+import snippets
+
+#how many highlights may be in progress at once by default
+defaultConcurrency = 4
+
+_defaultExecutor = None
+
+def defaultExecutor():
+	"""Returns the executor used when none is given, starting it on first use
+
+	Threads keep the event loop responsive, since the highlighting thread gives up
+	the GIL regularly. For throughput across cores, pass a ProcessPoolExecutor
+	(with snippets.warmup as its initializer) instead"""
+	global _defaultExecutor
+	if _defaultExecutor is None:
+		_defaultExecutor = concurrent.futures.ThreadPoolExecutor(max_workers = defaultConcurrency)
+	return _defaultExecutor
+
+async def highlightDocAsync(doc, query, timeout = None, executor = None, **options):
+	"""Highlights snippets in a document without blocking the event loop
+	Args:
+		doc -- document to be highlighted
+		query -- the search string
+		timeout -- give up with asyncio.TimeoutError after this many seconds
+		executor -- where to run the highlighting; defaults to defaultExecutor()
+		options -- passed on to Snipper, eg maxWords
+
+	Returns:
+		The most relevant snippets from the document with the search terms highlighted.
+
+	Cancelling the call stops waiting right away; highlighting which hasn't started
+	yet is dropped, but highlighting already running in the executor finishes there"""
+	loop = asyncio.get_running_loop()
+	highlight = functools.partial(snippets.highlightDocs, [doc], query, **options)
+	highlighted = await asyncio.wait_for(
+			loop.run_in_executor(executor or defaultExecutor(), highlight), timeout)
+	return highlighted[0]
+
+async def highlightDocsAsync(docs, query, timeout = None, executor = None,
+		concurrency = defaultConcurrency, **options):
+	"""Highlights snippets in many documents, yielding each one as soon as it's ready
+	Args:
+		docs -- the documents to be highlighted
+		query -- the search string
+		timeout -- how many seconds each document may take before asyncio.TimeoutError
+		executor -- where to run the highlighting; defaults to defaultExecutor()
+		concurrency -- at most this many documents are highlighted at once
+		options -- passed on to Snipper, eg maxWords
+
+	Yields:
+		(index, highlighted) pairs in the order they finish, where index is the
+		position of the document in docs
+
+	If the caller stops iterating, or a document fails or times out, the documents
+	which haven't been highlighted yet are cancelled"""
+	limit = asyncio.Semaphore(concurrency)
+
+	async def highlightOne(index, doc):
+		async with limit:
+			return index, await highlightDocAsync(doc, query, timeout, executor, **options)
+
+	tasks = [asyncio.ensure_future(highlightOne(index, doc)) for index, doc in enumerate(docs)]
+	try:
+		for finished in asyncio.as_completed(tasks):
+			yield await finished
+	finally:
+		for task in tasks:
+			task.cancel()
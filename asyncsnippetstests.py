@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+#Unit tests for the asyncio front end; these need python 3.7
+
+import unittest, asyncio
+import snippets, asyncsnippets
+
+class TestAsync(unittest.TestCase):
+	"""Tests highlighting from coroutines"""
+	docs = ["The quick brown fox jumped over a lazy dog.",
+			"This document does not include the names of any mammals",
+			"Foxes are not dogs. A fox is a fox."]
+
+	def testSingle(self):
+		"""Highlighting asynchronously should give the same result"""
+		highlighted = asyncio.run(asyncsnippets.highlightDocAsync(self.docs[0], 'fox', maxWords = 3))
+		self.assertEqual(highlighted, snippets.highlightDocs(self.docs[:1], 'fox', maxWords = 3)[0])
+
+	def testMany(self):
+		"""Every document should be yielded once, tagged with its position"""
+		async def collect():
+			return [pair async for pair in asyncsnippets.highlightDocsAsync(self.docs, 'fox', concurrency = 2)]
+
+		self.assertEqual(sorted(asyncio.run(collect())),
+				list(enumerate(snippets.highlightDocs(self.docs, 'fox'))))
+
+	def testTimeout(self):
+		"""Highlighting that takes too long should time out"""
+		commandline = open('command.txt').read() * 10
+		self.assertRaises(asyncio.TimeoutError, asyncio.run,
+				asyncsnippets.highlightDocAsync(commandline, 'operating system', timeout = 0.001))
+
+	def testCancel(self):
+		"""Cancelling should stop the caller waiting for the highlight"""
+		commandline = open('command.txt').read() * 10
+
+		async def cancelled():
+			task = asyncio.ensure_future(
+					asyncsnippets.highlightDocAsync(commandline, 'operating system'))
+			await asyncio.sleep(0)
+			task.cancel()
+			await task
+
+		self.assertRaises(asyncio.CancelledError, asyncio.run, cancelled())
+
+	def testStopEarly(self):
+		"""Documents not yet highlighted should be cancelled when the caller stops"""
+		async def firstOnly():
+			async for index, highlighted in asyncsnippets.highlightDocsAsync(self.docs * 10, 'fox',
+					concurrency = 1):
+				return index, highlighted
+
+		index, highlighted = asyncio.run(firstOnly())
+		self.assertEqual(highlighted, snippets.highlightDoc(self.docs[index], 'fox'))
+
+def suite():
+	return unittest.defaultTestLoader.loadTestsFromTestCase(TestAsync)
+
+if __name__ == "__main__":
+	allTests = suite()
+	unittest.TextTestRunner(verbosity=0).run(allTests)
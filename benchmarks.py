@@ -0,0 +1,439 @@
+#!/usr/bin/python
+#
+# Benchmarks for the snippet highlighter
+# run with: python benchmarks.py [name ...]
+
+"""Times the expensive parts of snippet highlighting"""
+from __future__ import print_function
+import sys, os, re, random, timeit, subprocess, tempfile
+from array import array
+
+import snippets, lexicon
+
+try:
+	xrange
+except NameError:
+	xrange = range		#python 3
+
+queries = ('deep dish pizza', 'happy hour', 'car wind', 'asteroid cherry',
+		'control freak', 'making your own', 'operating systems like razor blades')
+
+def bestTime(function, number = 1, repeat = 3):
+	"""Returns the best per-call time in seconds over several repeats"""
+	return min(timeit.repeat(function, number = number, repeat = repeat)) / number
+
+def report(name, seconds):
+	print("%-72s %10.3f ms" % (name, seconds * 1000))
+
+#the start of the scripts run in child processes. A child inherits ru_maxrss from its
+#parent across fork and exec, so it reads its own high water mark out of /proc instead
+childScript = """
+from __future__ import print_function
+
+def peakRss():
+	\"\"\"Returns the peak resident set size of this process in KB\"\"\"
+	for line in open('/proc/self/status'):
+		if line.startswith('VmHWM'):
+			return int(line.split()[1])
+"""
+
+def benchQueryExpansion():
+	"""Per-query expansion time with a linear scan of words.py vs the hashed lexicon"""
+	import words
+	commandline = open('command.txt').read()
+
+	for name, knownWords in (('list', words.words), ('lexicon', lexicon.defaultLexicon())):
+		s = snippets.Snipper(commandline, '', lexicon = knownWords)
+		for query in queries:
+			seconds = bestTime(lambda: s.buildQueryWordList(query))
+			report("expand %-8s %r" % (name, query), seconds)
+
+def benchLexiconStartup():
+	"""Cold start cost of importing words.py vs mapping the compiled lexicon"""
+	loaders = (
+			('import words.py', "import lexicon, words; knownWords = lexicon.Lexicon(words.words)"),
+			('mmap words.lex', "import lexicon; knownWords = lexicon.MappedLexicon()"),
+			)
+
+	#each load has to happen in a fresh interpreter or we'd just be timing the module cache
+	script = childScript + """
+import time
+start = time.time()
+%s
+'pizza' in knownWords
+print(time.time() - start, peakRss())
+"""
+	lexicon.compileLexicon(__import__('words').words, sourcePath = lexicon.defaultSourcePath)
+	for name, loader in loaders:
+		runs = []
+		for run in xrange(3):
+			output = subprocess.check_output([sys.executable, '-c', script % loader])
+			seconds, maxRss = output.split()
+			runs.append((float(seconds), int(maxRss)))
+		seconds, maxRss = min(runs)
+		report("startup %s (max rss %d KB)" % (name, maxRss), seconds)
+
+def benchTokenMemory():
+	"""Memory held per token by the token table vs the old dict per word"""
+	#the old representation is rebuilt from the table so that both are measured on the same words
+	layouts = (
+			('token table', "held = table"),
+			('dict per word', """held = [{
+		'fullword':table.fullword(index),
+		'word':table.word(index),
+		'originalWord':table.originalWord(index),
+		'tail':table.tail(index),
+		'matching':table.matching(index),
+		'score':table.scores[index],
+		'clauseEnder':table.clauseEnder(index),
+		} for index in xrange(len(table))]"""),
+			)
+
+	script = childScript + """
+import snippets
+try:
+	xrange
+except NameError:
+	xrange = range
+commandline = open('command.txt').read()
+s = snippets.Snipper(commandline, 'car wind')
+queryWords = s.buildQueryWordList(s.query)
+before = peakRss()
+table, bestWordIndex = s.buildWordScores(commandline, queryWords)
+%s
+del table
+print(len(held), peakRss() - before)
+"""
+	for name, layout in layouts:
+		output = subprocess.check_output([sys.executable, '-c', script % layout])
+		tokens, grownKb = [int(field) for field in output.split()]
+		print("%-60s %10d tokens %8.1f bytes/token" % (
+				"memory %s (+%d KB max rss)" % (name, grownKb), tokens, grownKb * 1024.0 / tokens))
+
+	commandline = open('command.txt').read()
+	s = snippets.Snipper(commandline, 'car wind')
+	table, bestWordIndex = s.buildWordScores(commandline, s.buildQueryWordList(s.query))
+	print("%-60s %10d tokens %8.1f bytes/token" % (
+			"memory token table columns", len(table), table.byteSize() / float(len(table))))
+
+def benchHighlight():
+	"""Highlighting time for snippets of increasing size, which should grow linearly"""
+	commandline = open('command.txt').read()
+	s = snippets.Snipper(commandline, 'the a of operating system')
+	table, bestWordIndex = s.getScoredWords()
+
+	for size in (60, 1000, 10000):
+		seconds = bestTime(lambda: s.highlightSnippet(table, 0, size), number = 10)
+		report("highlight %5d words (%.2f us/word)" % (size, seconds * 1e6 / size), seconds)
+
+def benchMultipleSnippets():
+	"""Time to pick the k best snippets of command.txt, after scoring"""
+	commandline = open('command.txt').read()
+	for query in ('car wind', 'operating system', 'the'):
+		s = snippets.Snipper(commandline, query)
+		s.getScoredWords()
+		for k in (1, 3, 10):
+			seconds = bestTime(lambda: s.bestSnippetsHighlighted(k), number = 10)
+			report("best %2d snippets %r" % (k, query), seconds)
+
+def benchSnippetLengths():
+	"""Mobile and desktop length snippets from fresh snippers vs one snipper changing maxWords"""
+	commandline = open('command.txt').read()
+	sizes = (20, 60)
+
+	def freshSnippers():
+		return [snippets.Snipper(commandline, 'operating system', maxWords = size).bestSnippetHighlighted
+				for size in sizes]
+
+	def oneSnipper():
+		s = snippets.Snipper(commandline, 'operating system')
+		highlighted = []
+		for size in sizes:
+			s.maxWords = size
+			highlighted.append(s.bestSnippetHighlighted)
+		return highlighted
+
+	for name, highlight in (('a snipper per length', freshSnippers), ('one snipper', oneSnipper)):
+		seconds = bestTime(highlight)
+		report("%s snippets with %s" % ("/".join(str(size) for size in sizes), name), seconds)
+
+def benchQueryLength():
+	"""Scoring time for queries of 1 to 50 terms, which should stay flat"""
+	commandline = open('command.txt').read()
+	s = snippets.Snipper(commandline, '')
+	table, bestWordIndex = s.getScoredWords()
+	terms = sorted(set(table.word(index) for index in xrange(len(table))))[:50]
+
+	for length in (1, 5, 10, 25, 50):
+		queryWords = frozenset(terms[:length])
+		seconds = bestTime(lambda: s.buildWordScores(commandline, queryWords))
+		report("score %2d query terms" % length, seconds)
+
+def benchCoverage():
+	"""Decaying vs coverage scoring for queries of 1 to 50 terms, which should both stay flat"""
+	commandline = open('command.txt').read()
+	s = snippets.Snipper(commandline, '')
+	table, bestWordIndex = s.getScoredWords()
+	terms = sorted(set(table.word(index) for index in xrange(len(table))))[:50]
+
+	def coverageScores(queryWords, termGroups):
+		matchPositions = []
+		table = s.buildMatchTable(commandline, queryWords, matchPositions)
+		return s.scoreCoverage(table, matchPositions, termGroups)
+
+	for length in (1, 5, 10, 25, 50):
+		queryWords = frozenset(terms[:length])
+		termGroups = [frozenset([term]) for term in terms[:length]]
+		seconds = bestTime(lambda: s.buildWordScores(commandline, queryWords))
+		report("decay score %2d query terms" % length, seconds)
+		seconds = bestTime(lambda: coverageScores(queryWords, termGroups))
+		report("coverage score %2d query terms" % length, seconds)
+
+def benchWindowScoring():
+	"""Window scoring with the python and numpy backends for documents from 1 KB to 100 MB
+
+	Only the scoring is timed: the tables are made by repeating command.txt's words"""
+	commandline = open('command.txt').read()
+	s = snippets.Snipper(commandline, 'operating system')
+	table = s.buildMatchTable(commandline, s.getQueryWords())
+	wordsPerByte = len(table) / float(len(commandline))
+	backends = ['python'] + (['numpy'] if snippets.numpy is not None else [])
+
+	for size in (1e3, 1e5, 1e6, 1e7, 1e8):
+		words = int(size * wordsPerByte)
+		sized = snippets.TokenTable(commandline)
+		sized.starts = array('l', [0]) * words
+		sized.flags = (table.flags * (words // len(table) + 1))[:words]
+		sized.scores = array('i', [0]) * words
+
+		for backend in backends:
+			windowSums = getattr(snippets.WindowScoring, backend + 'WindowSums')
+			seconds = bestTime(lambda: windowSums(sized, 60), repeat = 1 if size >= 1e7 else 3)
+			report("window scores, %s, %d KB (%d words)" % (backend, size / 1000, words), seconds)
+
+def benchExactScoring():
+	"""Scoring command.txt with the decaying heuristic vs the exact window sums"""
+	commandline = open('command.txt').read()
+	tokenized = snippets.TokenizedDocument(commandline)
+	strategies = [('decay', snippets.DecayScoring()), ('exact python', snippets.WindowScoring('python'))]
+	if snippets.numpy is not None:
+		strategies.append(('exact numpy', snippets.WindowScoring('numpy')))
+
+	for query in ('car wind', 'operating system', 'the'):
+		for name, strategy in strategies:
+			s = snippets.Snipper(tokenized, query, scoring = strategy)
+			s.getQueryWords()
+			seconds = bestTime(lambda: strategy.score(s), number = 5)
+			report("score tokenized command.txt, %s %r" % (name, query), seconds)
+
+def benchStreaming():
+	"""Time and memory of full scoring vs the streaming scorer on a large document"""
+	modes = (
+			('full table', "{}"),
+			('streaming', "{'streaming':True}"),
+			('early exit', "{'earlyExit':True}"),
+			)
+
+	script = childScript + """
+import time, snippets
+document = open('command.txt').read() * 20
+s = snippets.Snipper(document, 'operating system', **%s)
+s.buildQueryWordList(s.query)
+before = peakRss()
+start = time.time()
+s.bestSnippet
+print(time.time() - start, peakRss() - before)
+"""
+	for name, options in modes:
+		output = subprocess.check_output([sys.executable, '-c', script % options])
+		seconds, grownKb = output.decode('ascii').split()
+		report("score 4 MB document, %s (+%s KB max rss)" % (name, grownKb), float(seconds))
+
+def benchMappedDocument():
+	"""Reading a large file into a string vs memory-mapping it"""
+	loaders = (
+			('read() into str', "snippets.Snipper(open(path).read(), 'operating system', streaming = True)"),
+			('mmap', "snippets.Snipper.fromFile(path, 'operating system', streaming = True)"),
+			)
+
+	#RssAnon is the memory that's ours alone; mapped file pages can be dropped and reloaded
+	script = childScript + """
+import time, snippets
+path = %r
+start = time.time()
+s = %s
+s.bestSnippet
+seconds = time.time() - start
+anonKb = [line.split()[1] for line in open('/proc/self/status') if line.startswith('RssAnon')][0]
+print(seconds, peakRss(), anonKb)
+"""
+	commandline = open('command.txt', 'rb').read()
+	handle, path = tempfile.mkstemp()
+	try:
+		for repeat in xrange(100):
+			os.write(handle, commandline)
+		os.close(handle)
+
+		for name, loader in loaders:
+			output = subprocess.check_output([sys.executable, '-c', script % (path, loader)])
+			seconds, maxRss, anonKb = output.decode('ascii').split()
+			report("snippet 21 MB file, %s (max rss %s KB, anon %s KB)" % (name, maxRss, anonKb),
+					float(seconds))
+	finally:
+		os.remove(path)
+
+def benchManyDocuments():
+	"""Throughput of highlightDocs vs calling highlightDoc on each document"""
+	paragraphs = [paragraph for paragraph in re.split(r'\n\s*\n', open('command.txt').read()) if paragraph.strip()]
+
+	for count in (10, 50):
+		docs = paragraphs[:count]
+		for name, highlight in (
+				('highlightDoc loop', lambda: [snippets.highlightDoc(doc, 'operating system') for doc in docs]),
+				('highlightDocs', lambda: snippets.highlightDocs(docs, 'operating system'))):
+			seconds = bestTime(highlight, number = 10)
+			report("%2d docs with %s (%.0f docs/sec)" % (count, name, count / seconds), seconds)
+
+def benchParallel():
+	"""Throughput of highlightMany as the number of worker processes grows"""
+	import multiprocessing
+	paragraphs = [paragraph for paragraph in re.split(r'\n\s*\n', open('command.txt').read()) if paragraph.strip()]
+	docs = paragraphs * 20
+
+	seconds = bestTime(lambda: snippets.highlightDocs(docs, 'operating system'), repeat = 1)
+	report("%d docs in this process (%.0f docs/sec)" % (len(docs), len(docs) / seconds), seconds)
+
+	for processes in sorted(set([1, 2, 4, multiprocessing.cpu_count()])):
+		with snippets.ParallelSnipper(processes) as parallel:
+			parallel.highlight(docs[:processes], 'operating system')		#start the workers up
+			seconds = bestTime(lambda: parallel.highlight(docs, 'operating system'), repeat = 1)
+		report("%d docs on %d processes (%.0f docs/sec)" % (len(docs), processes, len(docs) / seconds), seconds)
+
+def benchTokenizedDocument():
+	"""Per-query time for 1,000 queries against the raw text vs a pre-tokenized document"""
+	commandline = open('command.txt').read()
+	tokenized = snippets.TokenizedDocument(commandline)
+
+	#pairs of the document's own words, so that every query has matches
+	random.seed(0)
+	queries = [" ".join(random.sample(tokenized.terms, 2)) for query in xrange(1000)]
+	for query in queries:
+		snippets.Snipper('', query).buildQueryWordList(query)		#keep expansion out of the timing
+
+	seconds = bestTime(lambda: snippets.TokenizedDocument(commandline))
+	report("tokenize command.txt once", seconds)
+
+	for name, doc in (('raw text', commandline), ('pre-tokenized', tokenized)):
+		seconds = bestTime(lambda: [snippets.Snipper(doc, query).bestSnippetHighlighted for query in queries],
+				repeat = 1)
+		report("%d queries on %s (%.2f ms/query)" % (len(queries), name, seconds * 1000 / len(queries)), seconds)
+
+def benchSavedTokens():
+	"""Cold start cost of re-tokenizing a document vs loading its saved token table"""
+	#each load has to happen in a fresh interpreter, like a newly started worker
+	script = """
+from __future__ import print_function
+import time, snippets
+doc = open('command.txt').read()
+start = time.time()
+%s
+loaded = time.time()
+snippets.Snipper(tokens, 'operating system').bestSnippetHighlighted
+print(loaded - start, time.time() - start)
+"""
+	handle, path = tempfile.mkstemp()
+	os.close(handle)
+	try:
+		snippets.TokenizedDocument(open('command.txt').read()).save(path)
+		print("%-72s %10d KB" % ("saved token table for command.txt", os.path.getsize(path) / 1024))
+
+		loaders = (
+				('re-tokenize', "tokens = snippets.TokenizedDocument(doc)"),
+				('load saved', "tokens = snippets.MappedTokenizedDocument(%r, doc)" % path),
+				)
+
+		for name, loader in loaders:
+			runs = []
+			for run in xrange(3):
+				output = subprocess.check_output([sys.executable, '-c', script % loader])
+				runs.append([float(field) for field in output.split()])
+			loadSeconds, snippetSeconds = min(runs)
+			report("%s (first snippet after %.1f ms)" % (name, snippetSeconds * 1000), loadSeconds)
+	finally:
+		os.remove(path)
+
+def benchIndex():
+	"""Searching an index of command.txt's paragraphs vs snipping every paragraph"""
+	paragraphs = [paragraph for paragraph in re.split(r'\n\s*\n', open('command.txt').read()) if paragraph.strip()]
+	index = snippets.SnippetIndex()
+	seconds = bestTime(lambda: [index.addDocument(paragraph) for paragraph in paragraphs], repeat = 1)
+	report("index %d paragraphs" % len(paragraphs), seconds)
+
+	for query in queries:
+		index.search(query)		#keep expansion out of the timing
+		seconds = bestTime(lambda: snippets.highlightDocs(paragraphs, query))
+		report("snip every paragraph %r" % query, seconds)
+		seconds = bestTime(lambda: index.highlight(query, limit = 10), number = 10)
+		report("search and snip the best 10 %r" % query, seconds)
+
+def benchMatchScores():
+	"""Scoring a large tokenized document into a full table vs keeping just the best window"""
+	tokenized = snippets.TokenizedDocument(open('command.txt').read() * 10)
+
+	for query in ('asteroid cherry', 'control freak', 'operating system', 'the'):
+		s = snippets.Snipper(tokenized, query)
+		queryWords = s.buildQueryWordList(query)
+		matches = len(tokenized.matchPositions(queryWords))
+
+		seconds = bestTime(lambda: s.buildWordScores(tokenized, queryWords))
+		report("full table, %d words, %d matches %r" % (len(tokenized), matches, query), seconds)
+		seconds = bestTime(lambda: s.buildMatchScores(tokenized, tokenized.matchPositions(queryWords)), number = 10)
+		report("best window, %d words, %d matches %r" % (len(tokenized), matches, query), seconds)
+
+def benchTokenizer():
+	"""Tokenization throughput of the shared tokenizer vs compiling a regex per document"""
+	commandline = open('command.txt').read()
+	megabytes = len(commandline) / 1e6
+
+	def compilePerDocument():
+		wordRe = re.compile(r"""([a-z0-9'`"]+)([^a-z0-9'`"]+|$)""", re.IGNORECASE)
+		re.purge()		#otherwise re's own cache hands the compiled pattern straight back
+		return [(word.group(1), commandline.startswith(('.', ';'), word.start(2)))
+				for word in wordRe.finditer(commandline)]
+
+	def sharedTokenizer():
+		return [(word.group(1), word.start(3) >= 0)
+				for word in snippets.defaultTokenizer.matches(commandline)]
+
+	for name, tokenize in (
+			('compiled per document', compilePerDocument),
+			('shared tokenizer', sharedTokenizer)):
+		seconds = bestTime(tokenize)
+		report("tokenize %.1f MB, %s (%.1f MB/s)" % (megabytes, name, megabytes / seconds), seconds)
+
+benchmarks = {
+		'exact':benchExactScoring,
+		'expansion':benchQueryExpansion,
+		'coverage':benchCoverage,
+		'batch':benchManyDocuments,
+		'highlight':benchHighlight,
+		'window':benchWindowScoring,
+		'index':benchIndex,
+		'mmap':benchMappedDocument,
+		'multiple':benchMultipleSnippets,
+		'lengths':benchSnippetLengths,
+		'matchscores':benchMatchScores,
+		'parallel':benchParallel,
+		'querylength':benchQueryLength,
+		'streaming':benchStreaming,
+		'tokenize':benchTokenizer,
+		'tokenized':benchTokenizedDocument,
+		'savedtokens':benchSavedTokens,
+		'memory':benchTokenMemory,
+		'startup':benchLexiconStartup,
+		}
+
+if __name__ == "__main__":
+	names = sys.argv[1:] or sorted(benchmarks)
+	for name in names:
+		benchmarks[name]()
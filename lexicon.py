@@ -0,0 +1,245 @@
+#!/usr/bin/python
+#
+# Igor Serebryany
+
+"""Dictionary lookups for the snippet highlighter
+
+The word list lives in words.py, which is a very large python source file and slow
+to import. Running this module compiles it into words.lex, a sorted binary table
+which can be memory-mapped instead:
+
+	python lexicon.py [words.lex]"""
+import hashlib, mmap, os, struct, threading, time
+
+try:
+	xrange
+except NameError:
+	xrange = range		#python 3
+
+#the compiled format is a header, a table of offsets and the sorted words back to back
+#	header -- magic, format version, number of words, sha1 of the word list's source file
+#		(all zeros if it wasn't compiled from one)
+#	offsets -- count + 1 little-endian uint32s; word i is data[offsets[i]:offsets[i + 1]]
+#	data -- the utf-8 encoded words, sorted bytewise
+MAGIC = b'SNLX'
+VERSION = 2
+headerFormat = '<4sII20s'
+headerSize = struct.calcsize(headerFormat)
+offsetFormat = '<I'
+offsetSize = struct.calcsize(offsetFormat)
+
+ENCODING = 'utf-8'
+
+defaultCompiledPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'words.lex')
+defaultSourcePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'words.py')
+
+def sourceDigest(path = defaultSourcePath):
+	"""Returns the sha1 of a word list's source file, as recorded in compiled lexicons"""
+	with open(path, 'rb') as sourceFile:
+		return hashlib.sha1(sourceFile.read()).digest()
+
+def _toBytes(word):
+	"""The compiled lexicon stores bytes, so unicode words need to be encoded"""
+	if isinstance(word, bytes):
+		return word
+	return word.encode(ENCODING)
+
+class Lexicon(object):
+	"""A set of known english words
+
+	The word list in words.py is a plain python list, so checking membership in it
+	means comparing against every one of its ~98,000 entries. This wraps the words
+	in a frozenset so that each lookup is a single hash probe"""
+
+	def __init__(self, words):
+		self._words = frozenset(words)
+
+	def __contains__(self, word):
+		return word in self._words
+
+	def __len__(self):
+		return len(self._words)
+
+	def __iter__(self):
+		return iter(self._words)
+
+class MappedLexicon(object):
+	"""A set of known english words backed by a compiled lexicon file
+
+	The file is memory-mapped rather than read, so loading it is nearly free and the
+	pages are shared between every process which maps it. Lookups are a binary search
+	over the sorted words"""
+
+	def __init__(self, path = defaultCompiledPath):
+		with open(path, 'rb') as lexiconFile:
+			self._map = mmap.mmap(lexiconFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+		if len(self._map) < headerSize:
+			self._map.close()
+			raise ValueError("%s is too short to be a compiled lexicon" % path)
+
+		magic, version, self._count, self.sourceDigest = struct.unpack_from(headerFormat, self._map, 0)
+		if magic != MAGIC or version != VERSION:
+			self._map.close()
+			raise ValueError("%s is not a version %d compiled lexicon" % (path, VERSION))
+
+		self._dataStart = headerSize + offsetSize * (self._count + 1)
+
+	def _word(self, index):
+		"""Returns the word at the given index of the sorted table"""
+		start, end = struct.unpack_from('<II', self._map, headerSize + offsetSize * index)
+		return self._map[self._dataStart + start:self._dataStart + end]
+
+	def __contains__(self, word):
+		try:
+			word = _toBytes(word)
+		except UnicodeError:
+			return False
+
+		low, high = 0, self._count
+		while low < high:
+			middle = (low + high) // 2
+			if self._word(middle) < word:
+				low = middle + 1
+			else:
+				high = middle
+
+		return low < self._count and self._word(low) == word
+
+	def __len__(self):
+		return self._count
+
+	def __iter__(self):
+		"""Yields the words in the same form words.py holds them, like Lexicon: byte
+		strings under python 2 and text under python 3"""
+		decode = bytes is not str
+		for index in xrange(self._count):
+			word = self._word(index)
+			yield word.decode(ENCODING) if decode else word
+
+	def close(self):
+		self._map.close()
+
+def compileLexicon(words, path = defaultCompiledPath, sourcePath = None):
+	"""Writes words into a compiled lexicon file which can be loaded by MappedLexicon
+
+	If the words came from sourcePath, its digest is recorded so that loadLexicon can
+	tell when the compiled lexicon is out of date"""
+	digest = sourceDigest(sourcePath) if sourcePath is not None else b'\0' * 20
+	sortedWords = sorted(set(_toBytes(word) for word in words))
+
+	offsets = [0]
+	for word in sortedWords:
+		offsets.append(offsets[-1] + len(word))
+
+	#write to the side and rename so that nobody ever maps a half-written file
+	temporaryPath = path + '.tmp'
+	with open(temporaryPath, 'wb') as lexiconFile:
+		lexiconFile.write(struct.pack(headerFormat, MAGIC, VERSION, len(sortedWords), digest))
+		lexiconFile.write(struct.pack('<%dI' % len(offsets), *offsets))
+		lexiconFile.write(b''.join(sortedWords))
+	os.rename(temporaryPath, path)
+
+def loadLexicon(compiledPath = defaultCompiledPath, sourcePath = defaultSourcePath):
+	"""Loads the best available lexicon
+
+	The compiled lexicon is used if it exists and was compiled from words.py as it is
+	now, which is checked by digest since checkouts don't keep file times meaningful.
+	A deployment may ship only the compiled lexicon, so without words.py it's used as
+	it is. Otherwise we fall back to importing words.py"""
+	try:
+		compiled = MappedLexicon(compiledPath)
+	except (OSError, IOError, ValueError):
+		pass			#no usable compiled lexicon
+	else:
+		try:
+			digest = sourceDigest(sourcePath)
+		except (OSError, IOError):
+			return compiled		#no word list to be out of date with
+		if compiled.sourceDigest == digest:
+			return compiled
+		compiled.close()		#compiled from another version of the word list
+
+	import words
+	return Lexicon(words.words)
+
+class LexiconRegistry(object):
+	"""Holds the lexicon shared by everything in this process
+
+	The lexicon is loaded lazily on first use. Pre-fork servers should call warmup()
+	before forking so that the children share the loaded pages copy-on-write instead
+	of each paying for the load on their first request"""
+
+	def __init__(self, loader = loadLexicon):
+		self._loader = loader
+		self._lexicon = None
+		self._lock = threading.Lock()
+
+		self.loadedAt = None		#time.time() when the lexicon finished loading
+		self.loadSeconds = None		#how long the load took
+		self.loadedBy = None		#'warmup' or 'lazy'
+		self.loadedInPid = None		#a pid other than ours means we were forked after loading
+		self.loads = 0
+
+	@property
+	def loaded(self):
+		return self._lexicon is not None
+
+	def get(self):
+		"""Returns the lexicon, loading it if nobody has yet"""
+		if self._lexicon is None:
+			self._load('lazy')
+		return self._lexicon
+
+	def warmup(self):
+		"""Loads the lexicon now rather than on first use"""
+		if self._lexicon is None:
+			self._load('warmup')
+		return self._lexicon
+
+	def reset(self):
+		"""Forgets the loaded lexicon; the next get() loads it again"""
+		with self._lock:
+			self._lexicon = None
+			self.loadedAt = self.loadSeconds = self.loadedBy = self.loadedInPid = None
+
+	def _load(self, reason):
+		with self._lock:
+			#somebody else may have loaded it while we waited for the lock
+			if self._lexicon is not None:
+				return
+
+			start = time.time()
+			knownWords = self._loader()
+			self.loadSeconds = time.time() - start
+			self.loadedAt = time.time()
+			self.loadedBy = reason
+			self.loadedInPid = os.getpid()
+			self.loads += 1
+			self._lexicon = knownWords
+
+	def stats(self):
+		"""Returns a dictionary describing whether, when and how the lexicon was loaded"""
+		return {
+				'loaded':self.loaded,
+				'type':type(self._lexicon).__name__ if self.loaded else None,
+				'loadedAt':self.loadedAt,
+				'loadSeconds':self.loadSeconds,
+				'loadedBy':self.loadedBy,
+				'loadedInPid':self.loadedInPid,
+				'loads':self.loads,
+				}
+
+#the lexicon shared by the whole process
+registry = LexiconRegistry()
+
+def defaultLexicon():
+	"""Returns the process-wide lexicon, loading it on first use"""
+	return registry.get()
+
+if __name__ == "__main__":
+	import sys, words
+
+	path = sys.argv[1] if len(sys.argv) > 1 else defaultCompiledPath
+	compileLexicon(words.words, path, defaultSourcePath)
+	print("compiled %d words into %s" % (len(words.words), path))
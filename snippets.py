@@ -4,7 +4,733 @@
 # Yelp Code Test 7/25/09
 
 """Does the yelp puzzle of snippet highlighting"""
-import re
+import re, os, sys, abc, mmap, struct, bisect, heapq, itertools, multiprocessing, threading
+from array import array
+from collections import OrderedDict, deque
+
+import lexicon
+
+try:
+	import numpy
+except ImportError:
+	numpy = None		#only needed by the numpy backend of WindowScoring
+
+try:
+	xrange
+except NameError:
+	xrange = range		#python 3
+
+class LRUCache(object):
+	"""A dictionary which holds at most maxSize items, evicting the least recently used
+
+	Keeps hit, miss and eviction counts so that the size can be tuned. Safe to share
+	between threads"""
+
+	def __init__(self, maxSize = 1024):
+		self._items = OrderedDict()
+		self._maxSize = maxSize
+		self._lock = threading.Lock()
+		self.hits = self.misses = self.evictions = 0
+
+	@property
+	def maxSize(self):
+		"""At most this many items are kept"""
+		return self._maxSize
+
+	@maxSize.setter
+	def maxSize(self, value):
+		if value < 0:
+			raise ValueError("Cache size cannot be negative")
+		with self._lock:
+			self._maxSize = value
+			self._evict()
+
+	def get(self, key):
+		"""Returns the item for key, or None if it's not cached"""
+		with self._lock:
+			try:
+				value = self._items.pop(key)
+			except KeyError:
+				self.misses += 1
+				return None
+
+			#re-inserting makes this the most recently used item
+			self._items[key] = value
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		with self._lock:
+			self._items.pop(key, None)
+			self._items[key] = value
+			self._evict()
+
+	def _evict(self):
+		while len(self._items) > self._maxSize:
+			self._items.popitem(last = False)
+			self.evictions += 1
+
+	def clear(self):
+		"""Drops all items and resets the statistics"""
+		with self._lock:
+			self._items.clear()
+			self.hits = self.misses = self.evictions = 0
+
+	def __len__(self):
+		return len(self._items)
+
+	def stats(self):
+		return {
+				'size':len(self._items),
+				'maxSize':self._maxSize,
+				'hits':self.hits,
+				'misses':self.misses,
+				'evictions':self.evictions,
+				}
+
+#expanded queries, shared by every Snipper using the default lexicon
+queryCache = LRUCache()
+
+def normalizeQuery(query):
+	"""Collapses whitespace so that equivalent queries share a cache entry"""
+	return " ".join(query.split())
+
+class TokenTable(object):
+	"""The words of a document, stored column by column
+
+	Rather than keeping an object per word, each word is a row across a few compact
+	arrays: the offsets of the word and of its tail in the document, a byte of flags
+	and a score. Text is only ever sliced out of the document when it is rendered"""
+
+	MATCHING = 1		#the word matches a query word
+	CLAUSE_ENDER = 2	#the word's tail ends a clause
+
+	def __init__(self, doc):
+		self.doc = doc
+		self.starts = array('l')		#where each word starts
+		self.tailStarts = array('l')	#where each word ends and its tail begins
+		self.tailEnds = array('l')		#where each tail ends
+		self.flags = array('B')
+		self.scores = array('i')
+
+	def append(self, start, tailStart, tailEnd, flags, score):
+		self.starts.append(start)
+		self.tailStarts.append(tailStart)
+		self.tailEnds.append(tailEnd)
+		self.flags.append(flags)
+		self.scores.append(score)
+
+	def __len__(self):
+		return len(self.starts)
+
+	def matching(self, index):
+		return bool(self.flags[index] & self.MATCHING)
+
+	def clauseEnder(self, index):
+		return bool(self.flags[index] & self.CLAUSE_ENDER)
+
+	def originalWord(self, index):
+		return self.doc[self.starts[index]:self.tailStarts[index]]
+
+	def word(self, index):
+		return self.originalWord(index).lower()
+
+	def tail(self, index):
+		return self.doc[self.tailStarts[index]:self.tailEnds[index]]
+
+	def fullword(self, index):
+		return self.doc[self.starts[index]:self.tailEnds[index]]
+
+	def matchRuns(self, firstIndex, lastIndex):
+		"""Returns (runStart, runEnd) for each run of consecutive matching words
+		between firstIndex and lastIndex"""
+		flags = self.flags
+		runs = []
+		runStart = None
+
+		for index in xrange(firstIndex, lastIndex):
+			if flags[index] & self.MATCHING:
+				if runStart is None:
+					runStart = index
+			elif runStart is not None:
+				runs.append((runStart, index))
+				runStart = None
+
+		if runStart is not None:
+			runs.append((runStart, lastIndex))
+
+		return runs
+
+	def snippetStart(self, firstIndex, lastIndex):
+		"""Returns the document offset where the words firstIndex up to lastIndex begin"""
+		if firstIndex >= lastIndex:
+			return 0
+		return self.starts[firstIndex]
+
+	def snippetEnd(self, firstIndex, lastIndex):
+		"""Returns the document offset where the words firstIndex up to lastIndex end"""
+		if firstIndex >= lastIndex:
+			return 0
+		return self.tailEnds[lastIndex - 1]
+
+	def snippet(self, firstIndex, lastIndex):
+		"""Returns the words firstIndex up to lastIndex along with their tails
+
+		Each word's tail runs right up to the start of the next word, so this is
+		a single slice of the document"""
+		return self.doc[self.snippetStart(firstIndex, lastIndex):self.snippetEnd(firstIndex, lastIndex)]
+
+	def scored(self, scores):
+		"""Returns a table of the same words with the given scores; the other columns are shared"""
+		table = TokenTable(self.doc)
+		table.starts, table.tailStarts, table.tailEnds, table.flags = \
+				self.starts, self.tailStarts, self.tailEnds, self.flags
+		table.scores = scores
+		return table
+
+	def rebased(self, doc, origin):
+		"""Returns a copy of this table pointing into doc, which is our doc starting at origin"""
+		table = TokenTable(doc)
+		table.starts = array('l', [start - origin for start in self.starts])
+		table.tailStarts = array('l', [start - origin for start in self.tailStarts])
+		table.tailEnds = array('l', [end - origin for end in self.tailEnds])
+		table.flags = array('B', self.flags)
+		table.scores = array('i', self.scores)
+		return table
+
+	def byteSize(self):
+		"""Returns how many bytes the columns take up, not counting the document"""
+		return sum(column.itemsize * len(column)
+				for column in (self.starts, self.tailStarts, self.tailEnds, self.flags, self.scores))
+
+class Tokenizer(object):
+	"""Splits documents into words, each followed by its tail of spaces and punctuation
+
+	Words are runs of word characters and everything between them is tail. A word
+	ends a clause if its tail starts with a clause character, which the regex spots
+	while matching. The regexes are compiled once, so keep a tokenizer around rather
+	than making one per document"""
+
+	def __init__(self, wordCharacters = "a-z0-9'`\"", clauseCharacters = ".;"):
+		"""Args:
+			wordCharacters -- the contents of a regex character class matching word characters
+			clauseCharacters -- the same for characters which end a clause; these must not
+				be word characters"""
+		#group 1 is the word, group 2 its tail, and group 3 is only set if the tail ends a clause
+		pattern = r"([%s]+)(([%s])?[^%s]*)" % (wordCharacters, clauseCharacters, wordCharacters)
+		self.wordRe = re.compile(pattern, re.IGNORECASE)
+
+		#mapped documents are scanned as bytes
+		try:
+			self.bytesWordRe = re.compile(pattern.encode('ascii'), re.IGNORECASE)
+		except UnicodeError:
+			self.bytesWordRe = None
+
+	def matches(self, document, position = 0):
+		"""Returns an iterator over the regex matches of the words in the document, from position
+
+		Mapped documents are scanned as raw bytes, straight out of the mapping"""
+		if isinstance(document, MappedDocument):
+			if self.bytesWordRe is None:
+				raise ValueError("This tokenizer's characters can't be matched in a mapped document")
+			return self.bytesWordRe.finditer(document.map, position)
+
+		return self.wordRe.finditer(document, position)
+
+	def words(self, document):
+		"""Yields (start, tailStart, tailEnd, word, clauseEnder) for each word in the document"""
+		decode = isinstance(document, MappedDocument) and bytes is not str
+
+		for word in self.matches(document):
+			yield (word.start(1), word.start(2), word.end(2),
+					word.group(1).decode('ascii') if decode else word.group(1),
+					word.start(3) >= 0)
+
+#the tokenizer used when a snipper isn't given one
+defaultTokenizer = Tokenizer()
+
+class MappedDocument(object):
+	"""A document read straight out of a memory-mapped file
+
+	The file is tokenized as bytes, so it's never copied into a string; only the text
+	of the snippet is sliced out and decoded. Offsets are byte offsets into the file.
+	Since words are made of ascii characters, this works for any ascii-compatible
+	encoding such as utf-8 or latin-1, but not for utf-16"""
+
+	def __init__(self, source, encoding = 'utf-8'):
+		"""Args:
+			source -- the path of the file, or an mmap object
+			encoding -- the encoding of the file's text"""
+		if isinstance(source, mmap.mmap):
+			self.map = source
+		else:
+			with open(source, 'rb') as documentFile:
+				#an empty file can't be mapped, but it's just an empty document
+				if os.fstat(documentFile.fileno()).st_size == 0:
+					self.map = b''
+				else:
+					self.map = mmap.mmap(documentFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+		self.encoding = encoding
+
+	def __getitem__(self, index):
+		"""Slices of the document are decoded; the offsets are in bytes"""
+		return self.map[index].decode(self.encoding)
+
+	def __len__(self):
+		return len(self.map)
+
+	def close(self):
+		if isinstance(self.map, mmap.mmap):
+			self.map.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+class TextStream(object):
+	"""A document which is read a chunk at a time rather than held in memory
+
+	Only the text from keepFrom onwards is buffered; whoever is consuming the words
+	should move keepFrom forward as soon as it no longer needs the earlier text.
+	Offsets are counted from the start of the whole stream. A stream can only be read
+	once: asking for its words again raises ValueError rather than giving just the
+	text that is still buffered"""
+
+	def __init__(self, source, chunkSize = 64 * 1024, tokenizer = defaultTokenizer):
+		"""Args:
+			source -- a file-like object with a read method, or an iterable of text chunks
+			chunkSize -- how much to read from a file-like source at a time
+			tokenizer -- splits the text into words"""
+		self._tokenizer = tokenizer
+		if hasattr(source, 'read'):
+			self._chunks = self._read(source, chunkSize)
+		else:
+			self._chunks = iter(source)
+
+		self._buffer = ''
+		self._bufferStart = 0		#the stream offset of the start of the buffer
+		self.keepFrom = 0
+		self.consumed = False		#whether words() has been called
+
+	@staticmethod
+	def _read(source, chunkSize):
+		while True:
+			chunk = source.read(chunkSize)
+			if not chunk:
+				return
+			yield chunk
+
+	def text(self, start, end):
+		"""Returns the text between two stream offsets, which must still be buffered"""
+		if start < self._bufferStart:
+			raise ValueError("Text at %d has already been discarded" % start)
+		return self._buffer[start - self._bufferStart:end - self._bufferStart]
+
+	def words(self):
+		"""Yields (start, tailStart, tailEnd, word, clauseEnder) for each word in the stream
+
+		A word at the very end of the buffer might continue in the next chunk, so it is
+		held back until more text arrives or the stream runs out"""
+		if self.consumed:
+			raise ValueError("This TextStream has already been read")
+		self.consumed = True
+
+		scannedTo = 0		#offset in the buffer up to which we've yielded words
+
+		for chunk in self._chunks:
+			#drop the text nobody needs anymore
+			dropped = min(self.keepFrom - self._bufferStart, scannedTo)
+			if dropped > 0:
+				self._buffer = self._buffer[dropped:]
+				self._bufferStart += dropped
+				scannedTo -= dropped
+
+			self._buffer += chunk
+			buffer, bufferStart = self._buffer, self._bufferStart
+
+			for word in self._tokenizer.matches(buffer, scannedTo):
+				if word.end(2) == len(buffer):
+					break		#this might continue in the next chunk
+
+				yield (bufferStart + word.start(1), bufferStart + word.start(2), bufferStart + word.end(2),
+						word.group(1), word.start(3) >= 0)
+				scannedTo = word.end(2)
+
+		#the stream is done, so whatever is left is complete
+		buffer, bufferStart = self._buffer, self._bufferStart
+		for word in self._tokenizer.matches(buffer, scannedTo):
+			yield (bufferStart + word.start(1), bufferStart + word.start(2), bufferStart + word.end(2),
+					word.group(1), word.start(3) >= 0)
+
+#saved token tables are a header, the word columns, the term offsets and the sorted terms
+#	header -- magic, format version, number of words, number of terms, length of the document
+#	starts, tailStarts, tailEnds, termIds -- one little-endian uint32 per word each
+#	termOffsets -- terms + 1 uint32s; term i is termData[termOffsets[i]:termOffsets[i + 1]]
+#	flags -- one byte per word
+#	termData -- the utf-8 encoded terms, sorted bytewise, so term ids are positions in this order
+TOKENS_MAGIC = b'SNTK'
+TOKENS_VERSION = 1
+tokensHeaderFormat = '<4sIIII'
+tokensHeaderSize = struct.calcsize(tokensHeaderFormat)
+
+def _littleEndian(column):
+	"""Returns the bytes of an array in little-endian order"""
+	if sys.byteorder != 'little':
+		column = array(column.typecode, column)
+		column.byteswap()
+	return column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+
+def _mappedColumn(buffer, offset, count, typecode):
+	"""Returns a column of count little-endian items of typecode stored at offset in buffer
+
+	Under python 3 this is a view straight into the buffer. Python 2's memoryview can't
+	be cast, so there the column is copied out, which is still a single memcpy"""
+	size = array(typecode).itemsize * count
+	if sys.byteorder == 'little' and hasattr(memoryview, 'cast'):
+		return memoryview(buffer)[offset:offset + size].cast(typecode)
+
+	column = array(typecode)
+	if hasattr(column, 'frombytes'):
+		column.frombytes(buffer[offset:offset + size])
+	else:
+		column.fromstring(buffer[offset:offset + size])
+	if sys.byteorder != 'little':
+		column.byteswap()
+	return column
+
+class TokenizedDocument(object):
+	"""A document which is split into words once and then snipped for any number of queries
+
+	Each word is kept as its offsets, whether it ends a clause, and the id of its
+	lowercased form in the document's vocabulary. Scoring a query then only has to look
+	up which vocabulary entries match it, rather than running the tokenizer again"""
+
+	def __init__(self, doc, tokenizer = None):
+		"""Args:
+			doc -- the document text, or a MappedDocument
+			tokenizer -- splits the document into words; defaults to defaultTokenizer"""
+		self.doc = doc
+		self.starts = array('l')
+		self.tailStarts = array('l')
+		self.tailEnds = array('l')
+		self.flags = array('B')			#only CLAUSE_ENDER; matching depends on the query
+		self.termIds = array('l')		#each word's index in terms
+		self.terms = []					#the distinct lowercased words of the document
+		self._termIndex = {}			#term -> id
+		self._termPositions = None
+
+		for start, tailStart, tailEnd, word, clauseEnder in (tokenizer or defaultTokenizer).words(doc):
+			term = word.lower()
+			termId = self._termIndex.get(term)
+			if termId is None:
+				termId = self._termIndex[term] = len(self.terms)
+				self.terms.append(term)
+
+			self.starts.append(start)
+			self.tailStarts.append(tailStart)
+			self.tailEnds.append(tailEnd)
+			self.flags.append(TokenTable.CLAUSE_ENDER if clauseEnder else 0)
+			self.termIds.append(termId)
+
+	def __len__(self):
+		return len(self.starts)
+
+	def term(self, termId):
+		return self.terms[termId]
+
+	def termId(self, term):
+		"""Returns the id of term, or None if it's not in the document"""
+		return self._termIndex.get(term)
+
+	def matchingTermIds(self, queryWords):
+		"""Returns the set of ids of the terms which are query words"""
+		termIds = [self.termId(word) for word in queryWords]
+		return frozenset(termId for termId in termIds if termId is not None)
+
+	def termPositions(self):
+		"""Returns {termId: array of the positions of the words with that term}
+
+		This is built on first use and then kept, so that finding the matches of
+		each later query costs only as much as there are matches"""
+		if self._termPositions is None:
+			termPositions = {}
+			for position, termId in enumerate(self.termIds):
+				termPositions.setdefault(termId, array('l')).append(position)
+			self._termPositions = termPositions
+
+		return self._termPositions
+
+	def matchPositions(self, queryWords):
+		"""Returns the sorted positions of the words which are query words"""
+		termPositions = self.termPositions()
+		positions = []
+		for termId in self.matchingTermIds(queryWords):
+			positions.extend(termPositions[termId])
+
+		positions.sort()
+		return positions
+
+	def words(self):
+		"""Yields (start, tailStart, tailEnd, word, clauseEnder) for each word, like Tokenizer.words"""
+		flags = self.flags
+		for index in xrange(len(self.starts)):
+			yield (self.starts[index], self.tailStarts[index], self.tailEnds[index],
+					self.term(self.termIds[index]), bool(flags[index] & TokenTable.CLAUSE_ENDER))
+
+	def save(self, path):
+		"""Writes the token table to path, to be loaded later by MappedTokenizedDocument
+
+		The document itself isn't saved; it should be stored alongside"""
+		terms = sorted((term if isinstance(term, bytes) else term.encode('utf-8'), termId)
+				for termId, term in enumerate(self.terms))
+
+		#term ids in the file are positions in the sorted term data
+		sortedIds = array('l', [0] * len(terms))
+		termOffsets = array('I', [0])
+		for sortedId, (term, termId) in enumerate(terms):
+			sortedIds[termId] = sortedId
+			termOffsets.append(termOffsets[-1] + len(term))
+
+		#write to the side and rename so that nobody ever maps a half-written file
+		temporaryPath = path + '.tmp'
+		with open(temporaryPath, 'wb') as tokensFile:
+			tokensFile.write(struct.pack(tokensHeaderFormat, TOKENS_MAGIC, TOKENS_VERSION,
+					len(self), len(terms), len(self.doc)))
+			for column in (self.starts, self.tailStarts, self.tailEnds):
+				tokensFile.write(_littleEndian(array('I', column)))
+			tokensFile.write(_littleEndian(array('I', [sortedIds[termId] for termId in self.termIds])))
+			tokensFile.write(_littleEndian(termOffsets))
+			tokensFile.write(_littleEndian(array('B', self.flags)))
+			tokensFile.write(b''.join(term for term, termId in terms))
+		os.rename(temporaryPath, path)
+
+class MappedTokenizedDocument(TokenizedDocument):
+	"""A TokenizedDocument loaded from a file written by TokenizedDocument.save
+
+	The file is memory-mapped, so a process that has never seen the document can snip
+	it without running the tokenizer; the columns are read straight out of the mapping
+	and terms are found by binary search over the sorted term data"""
+
+	def __init__(self, path, doc):
+		"""Args:
+			path -- the file the token table was saved to
+			doc -- the document text, or a MappedDocument, that was tokenized"""
+		with open(path, 'rb') as tokensFile:
+			self._map = mmap.mmap(tokensFile.fileno(), 0, access = mmap.ACCESS_READ)
+
+		try:
+			self._load(path, doc)
+		except ValueError:
+			self._map.close()
+			raise
+
+	def _load(self, path, doc):
+		"""Checks the header and the size of the mapped file, and maps the columns"""
+		if len(self._map) < tokensHeaderSize:
+			raise ValueError("%s is truncated" % path)
+
+		magic, version, wordCount, self._termCount, documentLength = \
+				struct.unpack_from(tokensHeaderFormat, self._map, 0)
+		if magic != TOKENS_MAGIC or version != TOKENS_VERSION:
+			raise ValueError("%s is not a version %d token table" % (path, TOKENS_VERSION))
+		if documentLength != len(doc):
+			raise ValueError("%s was saved for a different document" % path)
+
+		#the columns and term offsets have sizes fixed by the header, and the term data
+		#runs to the last term offset
+		termOffsetsStart = tokensHeaderSize + 16 * wordCount
+		termDataStart = termOffsetsStart + 4 * (self._termCount + 1) + wordCount
+		if len(self._map) < termDataStart:
+			raise ValueError("%s is truncated" % path)
+		termDataLength, = struct.unpack_from('<I', self._map, termOffsetsStart + 4 * self._termCount)
+		if len(self._map) < termDataStart + termDataLength:
+			raise ValueError("%s is truncated" % path)
+		if len(self._map) > termDataStart + termDataLength:
+			raise ValueError("%s is longer than its header says" % path)
+
+		self.doc = doc
+		self._termPositions = None
+		offset = tokensHeaderSize
+		self.starts, self.tailStarts, self.tailEnds, self.termIds = [
+				_mappedColumn(self._map, offset + column * 4 * wordCount, wordCount, 'I')
+				for column in xrange(4)]
+		offset += 16 * wordCount
+		self._termOffsets = _mappedColumn(self._map, offset, self._termCount + 1, 'I')
+		offset += 4 * (self._termCount + 1)
+		self.flags = _mappedColumn(self._map, offset, wordCount, 'B')
+		self._termDataStart = offset + wordCount
+
+	@property
+	def terms(self):
+		return [self.term(termId) for termId in xrange(self._termCount)]
+
+	def _termBytes(self, termId):
+		start = self._termDataStart + self._termOffsets[termId]
+		return self._map[start:self._termDataStart + self._termOffsets[termId + 1]]
+
+	def term(self, termId):
+		return self._termBytes(termId).decode('utf-8')
+
+	def termId(self, term):
+		"""Returns the id of term, or None if it's not in the document"""
+		if not isinstance(term, bytes):
+			term = term.encode('utf-8')
+
+		low, high = 0, self._termCount
+		while low < high:
+			middle = (low + high) // 2
+			if self._termBytes(middle) < term:
+				low = middle + 1
+			else:
+				high = middle
+
+		if low < self._termCount and self._termBytes(low) == term:
+			return low
+		return None
+
+	def close(self):
+		#views into the mapping have to go before it can be closed
+		for column in (self.starts, self.tailStarts, self.tailEnds, self.termIds, self._termOffsets, self.flags):
+			if isinstance(column, memoryview):
+				column.release()
+		self._map.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+#a base class for abstract classes which both python 2 and 3 accept
+_Abstract = abc.ABCMeta('_Abstract', (object,), {})
+
+class ScoringStrategy(_Abstract):
+	"""How a Snipper scores the words of a document
+
+	Each word is scored for the window of maxWords words which ends at it, and the
+	snippet is then built around the best scoring word by Snipper.findBestSnippet.
+	Subclasses implement score, and keepsWord if their scores don't show which words
+	match the way the decaying score does"""
+
+	@abc.abstractmethod
+	def score(self, snipper):
+		"""Returns a TokenTable of the words of snipper.doc and the index of the best word in it
+
+		The table may hold just the words around the best one, so long as it has the
+		maxWords words on either side that findBestSnippet looks at"""
+		raise NotImplementedError
+
+	def keepsWord(self, table, index):
+		"""Returns whether findBestSnippet must keep the word at index rather than cut the
+		snippet short in front of it"""
+		return table.matching(index)
+
+	def windowScores(self, snipper, table):
+		"""Returns the score of the window ending at each word of the table, used to rank
+		the candidates for several snippets (see Snipper.getBestSnippetWindows)"""
+		return table.scores
+
+class DecayScoring(ScoringStrategy):
+	"""The original heuristic: each matching word adds maxWords to a running score, which
+	decays by one every word (see Snipper.buildWordScores)"""
+
+	def score(self, snipper):
+		queryWords = snipper.getQueryWords()
+		if snipper.earlyExit:
+			return snipper.scanWordScores(snipper.doc, queryWords, snipper.buildQueryTermGroups(snipper.query))
+		if snipper.streaming:
+			return snipper.scanWordScores(snipper.doc, queryWords)
+
+		table, matchPositions = snipper.getMatchTable()
+		return snipper.scoreMatchTable(table, matchPositions)
+
+	def keepsWord(self, table, index):
+		#normally, the score decays by one each word. If the next word has a bigger
+		#score than the previous word, it's a matching word and cannot be cut
+		return table.scores[index - 1] < table.scores[index]
+
+class CoverageScoring(ScoringStrategy):
+	"""Scores windows by how many distinct query words they hold (see Snipper.scoreCoverage)"""
+
+	def score(self, snipper):
+		table, matchPositions = snipper.getMatchTable()
+		return snipper.scoreCoverage(table, matchPositions, snipper.buildQueryTermGroups(snipper.query))
+
+class WindowScoring(ScoringStrategy):
+	"""Scores each word by how many matching words the window of maxWords words ending at it holds
+
+	Unlike the decaying score, this is a plain windowed sum, so it can be computed a
+	whole array at a time. The 'numpy' backend does that with cumulative sums, the
+	'python' backend keeps a running sum; 'auto' uses numpy if it's installed"""
+
+	def __init__(self, backend = 'auto'):
+		if backend == 'auto':
+			backend = 'numpy' if numpy is not None else 'python'
+		if backend not in ('numpy', 'python'):
+			raise ValueError("Unknown backend %r" % (backend,))
+		if backend == 'numpy' and numpy is None:
+			raise ValueError("The numpy backend needs numpy to be installed")
+
+		self.backend = backend
+
+	def score(self, snipper):
+		table, matchPositions = snipper.getMatchTable()
+		table = table.scored(array('i', [0]) * len(table))
+		if self.backend == 'numpy':
+			bestWordIndex = self.numpyWindowSums(table, snipper.maxWords)
+		else:
+			bestWordIndex = self.pythonWindowSums(table, snipper.maxWords)
+		return table, bestWordIndex
+
+	@staticmethod
+	def pythonWindowSums(table, maxWords):
+		"""Fills in the table's scores with the windowed match counts; returns the index
+		of the best word, the earliest if several tie"""
+		flags, scores = table.flags, table.scores
+		bestWordIndex = 0
+		windowMatches = 0
+
+		for index in xrange(len(table)):
+			windowMatches += flags[index] & TokenTable.MATCHING
+			if index >= maxWords:
+				windowMatches -= flags[index - maxWords] & TokenTable.MATCHING
+
+			scores[index] = windowMatches
+			if windowMatches > scores[bestWordIndex]:
+				bestWordIndex = index
+
+		return bestWordIndex
+
+	@staticmethod
+	def numpyWindowSums(table, maxWords):
+		"""Does the same as pythonWindowSums, vectorized"""
+		if len(table) == 0:
+			return 0
+
+		matching = numpy.frombuffer(table.flags, dtype = numpy.uint8) & TokenTable.MATCHING
+		counts = numpy.cumsum(matching, dtype = numpy.int32)
+		windowSums = counts.copy()
+		windowSums[maxWords:] -= counts[:-maxWords]
+
+		table.scores = array('i')
+		if hasattr(table.scores, 'frombytes'):
+			table.scores.frombytes(windowSums.tobytes())
+		else:
+			table.scores.fromstring(windowSums.tostring())
+
+		#argmax picks the first of equal maximums, just as the other scorers do
+		return int(numpy.argmax(windowSums))
+
+#the strategies which can be picked by name
+scoringStrategies = {
+		'decay':DecayScoring,
+		'coverage':CoverageScoring,
+		'window':WindowScoring,
+		'exact':WindowScoring,		#the window sums find exactly the window with the most matches
+		}
 
 class Snipper(object):
 	"""An object that extracts and highlights snippets in documents
@@ -14,13 +740,124 @@ class Snipper(object):
 	This assumes that documents will be real english prose text -- it will not do well with
 	extensive math or strange characters"""
 
-	def __init__(self, doc, query, maxWords = 60, minPreceedingWords = 5):
-		self.doc = doc
-		self.query = query
+	def __init__(self, doc, query, maxWords = 60, minPreceedingWords = 5, lexicon = None,
+			streaming = False, earlyExit = False, tokenizer = None, scoring = 'decay'):
+		"""Args:
+			doc -- the document from which the snippet is extracted; a string, a MappedDocument
+				or a TokenizedDocument
+			query -- the search string
+			maxWords, minPreceedingWords -- see the properties of the same names
+			lexicon -- known words used to expand the query; defaults to the words.py lexicon
+			streaming -- only keep the words around the best one while scoring (see scanWordScores)
+			earlyExit -- stream, and stop at the first window holding every query word
+			tokenizer -- splits the document into words; defaults to defaultTokenizer
+			scoring -- a ScoringStrategy, or the name of one in scoringStrategies: 'decay' scores
+				words with the original decaying heuristic, 'coverage' by how many distinct query
+				words their window holds and 'window' (or 'exact') by how many matches it holds.
+				Only decay scoring streams; the others always score the whole document"""
+		if not isinstance(scoring, ScoringStrategy):
+			if scoring not in scoringStrategies:
+				raise ValueError("Unknown scoring %r" % (scoring,))
+			scoring = scoringStrategies[scoring]()
+
+		self._doc = doc
+		self._query = query
+		self._lexicon = lexicon
+		self.tokenizer = tokenizer or defaultTokenizer
+		self._streaming = streaming or earlyExit
+		self._earlyExit = earlyExit
+		self.scoring = scoring
+		self._fromStream = False		#whether doc is just the text kept by fromStream
+		self._ownsDoc = False			#whether doc was opened by fromFile, and so closed by close
 
 		self._maxWords = maxWords
 		self._minPreceedingWords = minPreceedingWords
 
+		#intermediate results, kept until the parameters they depend on change
+		self._queryWords = None			#depends on query
+		self._matchTable = None			#depends on doc and query
+		self._scoredWords = None		#depends on doc, query and maxWords
+		self._bestSnippetWindow = None	#depends on everything
+
+	@classmethod
+	def fromStream(cls, source, query, maxWords = 60, minPreceedingWords = 5, lexicon = None,
+			earlyExit = False, tokenizer = None, chunkSize = 64 * 1024):
+		"""Builds a snipper for a document which is read a chunk at a time
+
+		The document is scanned right away, and only the text around the best window
+		is kept, so memory use doesn't depend on the size of the document. That kept
+		text becomes the snipper's doc; changing maxWords afterwards rescores only it.
+		The rest of the document is gone, so the doc and query can't be changed and only
+		the best snippet can be found (see getBestSnippetWindows).
+
+		Args:
+			source -- a file-like object with a read method, or an iterable of text chunks
+			chunkSize -- how much to read from a file-like source at a time
+			the rest are as for the constructor"""
+		tokenizer = tokenizer or defaultTokenizer
+		snipper = cls(TextStream(source, chunkSize, tokenizer), query, maxWords, minPreceedingWords,
+				lexicon, streaming = True, earlyExit = earlyExit, tokenizer = tokenizer)
+
+		table, bestWordIndex = snipper.getScoredWords()
+		snipper._doc = table.doc
+		snipper._fromStream = True
+		return snipper
+
+	@classmethod
+	def fromFile(cls, source, query, *args, **kwargs):
+		"""Builds a snipper for a memory-mapped file
+
+		If source is a path, the snipper maps the file itself, and close() unmaps it; use
+		the snipper as a context manager or call close() when done. An mmap passed in is
+		left for the caller to close.
+
+		Args:
+			source -- the path of the file, or an mmap object
+			encoding -- the encoding of the file's text, utf-8 unless given by keyword
+			the rest are as for the constructor"""
+		encoding = kwargs.pop('encoding', 'utf-8')
+		snipper = cls(MappedDocument(source, encoding), query, *args, **kwargs)
+		snipper._ownsDoc = not isinstance(source, mmap.mmap)
+		return snipper
+
+	def close(self):
+		"""Unmaps the file mapped by fromFile; other documents belong to whoever made them"""
+		if self._ownsDoc:
+			self._doc.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+	@property
+	def doc(self):
+		"""The document from which the snippet is extracted"""
+		return self._doc
+
+	@doc.setter
+	def doc(self, value):
+		if value is not self._doc:
+			if self._fromStream:
+				raise ValueError("The doc of a snipper built from a stream can't be changed")
+			self._doc = value
+			self._matchTable = self._scoredWords = self._bestSnippetWindow = None
+
+	@property
+	def query(self):
+		"""The search string whose words are highlighted"""
+		return self._query
+
+	@query.setter
+	def query(self, value):
+		if value != self._query:
+			if self._fromStream:
+				raise ValueError("Only the text around the best window of the stream was kept, "
+						"so it can't be scored for another query")
+			self._query = value
+			self._queryWords = self._matchTable = self._scoredWords = self._bestSnippetWindow = None
+
 	@property
 	def maxWords(self):
 		"""At most this many words in the snippet"""
@@ -31,7 +868,10 @@ class Snipper(object):
 		"""We need at least 1 word in the snippet"""
 		if value < 1:
 			raise ValueError("Need at least 1 word in the snippet")
-		self._maxWords = value
+		if value != self._maxWords:
+			#the match table is kept, so only the scores and the window are worked out again
+			self._maxWords = value
+			self._scoredWords = self._bestSnippetWindow = None
 
 	@property
 	def minPreceedingWords(self):
@@ -42,90 +882,498 @@ class Snipper(object):
 	def minPreceedingWords(self, value):
 		if value < 0:
 			raise ValueError("Cannot have negative preceeding words")
-		return self._minPreceedingWords
+		if value != self._minPreceedingWords:
+			self._minPreceedingWords = value
+			self._bestSnippetWindow = None
+
+	@property
+	def streaming(self):
+		"""Whether only the words around the best one are kept while scoring"""
+		return self._streaming
+
+	@property
+	def earlyExit(self):
+		"""Whether scoring stops at the first window holding every query word"""
+		return self._earlyExit
+
+	@property
+	def lexicon(self):
+		"""The dictionary of known words used to expand the query"""
+		if self._lexicon is None:
+			return lexicon.defaultLexicon()
+		return self._lexicon
 
 	@property
 	def bestSnippet(self):
 		"""Returns the best snippet"""
-		bestSnippetWords = self.getBestSnippetWords()
-		return "".join([word['fullword'] for word in bestSnippetWords]).strip()
+		table, bestWordIndex = self.getScoredWords()
+		firstIndex, lastIndex = self.getBestSnippetWindow()
+		return table.snippet(firstIndex, lastIndex).strip()
 
 	@property
 	def bestSnippetHighlighted(self):
 		"""Returns the best snippet with the matches highlighted"""
-		bestSnippetWords = self.getBestSnippetWords()
-		return self.highlightSnippet(bestSnippetWords)
+		table, bestWordIndex = self.getScoredWords()
+		firstIndex, lastIndex = self.getBestSnippetWindow()
+		return self.highlightSnippet(table, firstIndex, lastIndex)
+
+	def getQueryWords(self):
+		"""Returns the set of words which match the query"""
+		if self._queryWords is None:
+			self._queryWords = self.buildQueryWordList(self.query)
+
+		return self._queryWords
+
+	def getScoredWords(self):
+		"""Returns the token table of the document and the index of the best scoring word
+
+		Each step is cached on the instance, so asking for both the plain and the
+		highlighted snippet only does the work once"""
+		if self._scoredWords is None:
+			self._scoredWords = self.scoring.score(self)
+
+		return self._scoredWords
+
+	def getBestSnippetWindow(self):
+		"""Returns the (firstIndex, lastIndex) slice of the token table in the best snippet"""
+		if self._bestSnippetWindow is None:
+			table, bestWordIndex = self.getScoredWords()
+			self._bestSnippetWindow = self.findBestSnippet(table, bestWordIndex)
+
+		return self._bestSnippetWindow
+
+	def getBestSnippetWindows(self, k):
+		"""Returns the token table and the (firstIndex, lastIndex) slices of it in the
+		k best snippets which don't overlap, in document order
+
+		Every word is a candidate for the best word of a snippet, and candidates are
+		taken from a heap, best score first. A candidate inside a snippet we already have
+		is skipped, as is one whose snippet would overlap one we have. The first snippet is
+		always the one getBestSnippetWindow finds.
+
+		Streaming snippers only keep the words around their best window, so for them the
+		document is scored again in full. That needs the document to be read again, so it
+		raises ValueError for a TextStream, or a snipper built with fromStream"""
+		if self._fromStream:
+			raise ValueError("Only the text around the best window of the stream was kept")
+		if self._streaming and isinstance(self.scoring, DecayScoring):
+			if isinstance(self.doc, TextStream):
+				raise ValueError("A TextStream can only be read once, so streaming only finds its best snippet")
+			table, matchPositions = self.getMatchTable()
+			table, bestWordIndex = self.scoreMatchTable(table, matchPositions)
+		else:
+			table, bestWordIndex = self.getScoredWords()
+
+		scores = self.scoring.windowScores(self, table)
+		candidates = [(-scores[index], index) for index in xrange(len(table)) if scores[index] > 0]
+		if not candidates:
+			candidates = [(0, bestWordIndex)]
+		heapq.heapify(candidates)
+
+		windows = []
+		while candidates and len(windows) < k:
+			score, index = heapq.heappop(candidates)
+			if any(firstIndex <= index < lastIndex for firstIndex, lastIndex in windows):
+				continue
+
+			window = self.findBestSnippet(table, index)
+			if all(window[1] <= firstIndex or lastIndex <= window[0] for firstIndex, lastIndex in windows):
+				windows.append(window)
+
+		return table, sorted(windows)
+
+	def bestSnippets(self, k, separator = " ... "):
+		"""Returns the k best snippets which don't overlap, in document order, joined by separator"""
+		table, windows = self.getBestSnippetWindows(k)
+		return separator.join(table.snippet(firstIndex, lastIndex).strip() for firstIndex, lastIndex in windows)
+
+	def bestSnippetsHighlighted(self, k, separator = " ... "):
+		"""Returns bestSnippets with the matches highlighted"""
+		table, windows = self.getBestSnippetWindows(k)
+		return separator.join(self.highlightSnippet(table, firstIndex, lastIndex) for firstIndex, lastIndex in windows)
 
 	def getBestSnippetWords(self):
 		"""Returns the word list of the words in the best snippet"""
-		queryWords = self.buildQueryWordList(self.query)
-		documentWords, bestWordIndex = self.buildWordScores(self.doc, queryWords)
-		bestSnippetWords = self.findBestSnippet(documentWords, bestWordIndex)
-
-		return bestSnippetWords
+		table, bestWordIndex = self.getScoredWords()
+		firstIndex, lastIndex = self.getBestSnippetWindow()
+		return [table.originalWord(index) for index in xrange(firstIndex, lastIndex)]
 
 	def buildWordScores(self, document, queryWords):
 		"""Parses out the words in the document and scores them
 		args:
-			doc -- the document from which words are extracted
-			queryWords -- a list of words which are scored highly
+			document -- the document from which words are extracted; a string, a MappedDocument,
+				a TextStream or a TokenizedDocument
+			queryWords -- the words which are scored highly
+
+		The result is a TokenTable with one row per word, holding the word's
+		offsets in the document, it's score and flags for whether it is a clause
+		ender or matches a query word, and the index of the best word. Matching words
+		add maxWords to a running score and every other word takes one away (see
+		scoreMatchPositions)"""
+		matchPositions = []
+		table = self.buildMatchTable(document, queryWords, matchPositions)
+		return self.scoreMatchTable(table, matchPositions)
+
+	def getMatchTable(self):
+		"""Returns the unscored TokenTable of the document, with the matching words flagged,
+		and the sorted positions of the matching words
+
+		These only depend on the doc and the query, so unlike the scores they're kept when
+		maxWords changes: another snippet length only reruns the scoring and the window"""
+		if self._matchTable is None:
+			matchPositions = []
+			table = self.buildMatchTable(self.doc, self.getQueryWords(), matchPositions)
+			self._matchTable = (table, matchPositions)
+
+		return self._matchTable
+
+	def buildMatchTable(self, document, queryWords, matchPositions = None):
+		"""Returns a TokenTable of the document's words with the matching ones flagged, unscored
+
+		args:
+			document -- a string, a MappedDocument, a TextStream or a TokenizedDocument
+			queryWords -- the words which match
+			matchPositions -- optionally, a list which the positions of the matching words are added to"""
+		if isinstance(document, TokenizedDocument):
+			positions = document.matchPositions(queryWords)
+			table = TokenTable(document.doc)
+			table.starts, table.tailStarts, table.tailEnds = document.starts, document.tailStarts, document.tailEnds
+			table.flags = array('B', document.flags)
+			for position in positions:
+				table.flags[position] |= TokenTable.MATCHING
+			table.scores = array('i', [0]) * len(document)
+
+			if matchPositions is not None:
+				matchPositions.extend(positions)
+			return table
+
+		streamed = isinstance(document, TextStream)
+		queryWords = frozenset(queryWords)
+		table = TokenTable(document)
+		words = document.words() if streamed else self.tokenizer.words(document)
+		for currentIndex, (start, tailStart, tailEnd, word, clauseEnder) in enumerate(words):
+			flags = TokenTable.CLAUSE_ENDER if clauseEnder else 0
+			if word.lower() in queryWords:
+				flags |= TokenTable.MATCHING
+				if matchPositions is not None:
+					matchPositions.append(currentIndex)
+			table.append(start, tailStart, tailEnd, flags, 0)
+
+		if streamed:
+			table = self._keepStreamText(table)
+		return table
+
+	def scoreCoverage(self, table, matchPositions, termGroups):
+		"""Scores each word by how much of the query the window of maxWords words ending at it covers
+
+		The decaying score counts every matching word, so "pizza pizza pizza" beats
+		"deep dish pizza". Here a window first scores by how many of the query's words it
+		holds at least one match for, and only then by how many matches it holds.
+
+		args:
+			table, matchPositions -- the match table of the document (see buildMatchTable)
+			termGroups -- one set of words per query word (see buildQueryTermGroups)
+
+		The window only changes where a match comes into it or leaves it maxWords words
+		later, so we sweep over just those points, keeping a count of the matches of each
+		query word in the window, and fill in the same score up to the next one.
+
+		Returns a copy of the table with the scores, and the index of the best word; the
+		earliest wins ties"""
+		maxWords = self.maxWords
+		wordCount = len(table)
+
+		#which query words each document word stands for
+		wordGroups = self.buildWordGroups(termGroups)
+		matchGroups = [wordGroups.get(table.word(position), ()) for position in matchPositions]
+
+		groupCounts = [0] * len(termGroups)		#matches of each query word in the window
+		coveredGroups = 0
+		windowMatches = 0
+
+		scores = array('i', [0]) * wordCount
+		bestWordIndex = 0
+		bestScore = 0
+
+		def nextChange():
+			#the next match to come into the window, or the next one to leave it maxWords words on
+			changes = [wordCount]
+			if entering < len(matchPositions):
+				changes.append(matchPositions[entering])
+			if leaving < entering:
+				changes.append(matchPositions[leaving] + maxWords)
+			return min(changes)
+
+		entering = leaving = 0
+		position = nextChange()
+		while position < wordCount:
+			while leaving < entering and matchPositions[leaving] + maxWords == position:
+				windowMatches -= 1
+				for groupIndex in matchGroups[leaving]:
+					groupCounts[groupIndex] -= 1
+					if groupCounts[groupIndex] == 0:
+						coveredGroups -= 1
+				leaving += 1
+
+			while entering < len(matchPositions) and matchPositions[entering] == position:
+				windowMatches += 1
+				for groupIndex in matchGroups[entering]:
+					if groupCounts[groupIndex] == 0:
+						coveredGroups += 1
+					groupCounts[groupIndex] += 1
+				entering += 1
+
+			#covering another query word beats any number of extra matches
+			score = coveredGroups * (maxWords + 1) + windowMatches
+			if score > bestScore:
+				bestWordIndex = position
+				bestScore = score
+
+			#the score holds until the window next changes
+			nextPosition = nextChange()
+			scores[position:nextPosition] = array('i', [score]) * (nextPosition - position)
+			position = nextPosition
+
+		return table.scored(scores), bestWordIndex
+
+	def scanWordScores(self, document, queryWords, termGroups = None):
+		"""Scores the words in the document like buildWordScores, keeping only the best window
+
+		Scoring a word needs only the scores of the previous word and of the word
+		maxWords back, so we keep the last maxWords + 1 words in a ring. Building the
+		snippet needs maxWords words on either side of the best word, so those are
+		copied out of the ring whenever the best word changes. Memory use is O(maxWords)
+		no matter how long the document is.
+
+		args:
+			document -- the document from which words are extracted; a string, a TextStream
+				or a TokenizedDocument
+			queryWords -- the words which are scored highly
+			termGroups -- optionally, one set of words per query word (see buildQueryTermGroups).
+				Scanning stops at the first window holding a word from every group, since
+				no window can cover more of the query
 
-		The result is a list of dictionaries, one dictionary per word,
-		containing the word, it's full expression, it's tail, score and
-		booleans for whether it is a clause ender or matches a query word"""
+		Returns a TokenTable holding just the words around the best word, and the index
+		of the best word in that table. findBestSnippet works on these just like on
+		the full table, since it never looks further than maxWords from the best word.
+		For a TextStream, the table points into a copy of just the text it covers"""
 
-		wordRe = re.compile(r"""([a-z0-9'`"]+)([^a-z0-9'`"]+|$)""", re.IGNORECASE)	#this is how we split out words
-		clauseIndicators = ('.', ';')
+		queryWords = frozenset(queryWords)
+		streamed = isinstance(document, TextStream)
+		tokenized = isinstance(document, TokenizedDocument)
 
-		words = []
+		#words away from any match score 0, so a tokenized document needn't be scanned at all
+		if tokenized and not termGroups:
+			return self.buildMatchScores(document, document.matchPositions(queryWords))
+		text = document.doc if tokenized else document		#what the table's offsets point into
+
+		ringSize = self.maxWords + 1
+		ringStarts, ringTailStarts, ringTailEnds = [array('l', [0] * ringSize) for column in xrange(3)]
+		ringFlags = array('B', [0] * ringSize)
+		ringScores = array('i', [0] * ringSize)
+
+		#the words kept around the best word, and the index of the first of them in the document
+		kept = TokenTable(text)
+		keptFrom = 0
 		bestWordIndex = 0
+		bestScore = 0
+		stillFollowing = 0		#how many words after the best word we still need to keep
+
+		#for early exit, how many words from each query word group are in the current window
+		if termGroups:
+			wordGroups = self.buildWordGroups(termGroups)
+			groupCounts = [0] * len(termGroups)
+			coveredGroups = 0
+			ringGroups = [()] * ringSize
+		exitIndex = None
 
-		for word in wordRe.finditer(document):
-			wordInfo = {
-					'fullword':word.group(0),
-					'word':word.group(1).lower(),
-					'originalWord':word.group(1),
-					'tail':word.group(2),
-					'matching':False,
-					'score':-1,		#non-matching words decay score by 1
-					'clauseEnder':False,
-					}
+		currentIndex = 0
+		score = 0
+		words = document.words() if streamed or tokenized else self.tokenizer.words(document)
+		for start, tailStart, tailEnd, word, clauseEnder in words:
+			previousScore = score
+			score = -1			#non-matching words decay score by 1
 
 			#determine if this ends a clause -- useful for building the snippet
-			for indicator in clauseIndicators:
-				if wordInfo['tail'].startswith(indicator):
-					wordInfo['clauseEnder'] = True
+			flags = TokenTable.CLAUSE_ENDER if clauseEnder else 0
 
 			#determine the score for this word
-			for queryWord in queryWords:
-				if queryWord == wordInfo['word']:
-					wordInfo['matching'] = True
-					#matching words jump score by the snippet size
-					wordInfo['score'] = self.maxWords
+			lowerWord = word.lower()
+			if lowerWord in queryWords:
+				flags |= TokenTable.MATCHING
+				#matching words jump score by the snippet size
+				score = self.maxWords
 
 			#combine with preceeding word to form score so far
-			if len(words) > 0:
-				wordInfo['score'] = max(wordInfo['score'] + words[-1]['score'], 0)
+			if currentIndex > 0:
+				score = max(score + previousScore, 0)
 			else:
-				wordInfo['score'] = 0
+				score = 0
 
 			#we want to eliminate the influence of words which don't even make it into this window
-			currentIndex = len(words)
 			lastOutOfWindow = currentIndex - self.maxWords
 			if lastOutOfWindow >= 0:
-				wordInfo['score'] = max(wordInfo['score'] - words[lastOutOfWindow]['score'], 0)
+				score = max(score - ringScores[lastOutOfWindow % ringSize], 0)
 
-			words.append(wordInfo)
+			slot = currentIndex % ringSize
+			ringStarts[slot], ringTailStarts[slot], ringTailEnds[slot] = start, tailStart, tailEnd
+			ringFlags[slot] = flags
+			ringScores[slot] = score
 
 			#are we now the bestest word?
-			if wordInfo['score'] > words[bestWordIndex]['score']:
+			newBest = currentIndex == 0 or score > bestScore
+
+			if termGroups and exitIndex is None:
+				#the word maxWords back has just left the window
+				if lastOutOfWindow >= 0:
+					for groupIndex in ringGroups[lastOutOfWindow % ringSize]:
+						groupCounts[groupIndex] -= 1
+						if groupCounts[groupIndex] == 0:
+							coveredGroups -= 1
+
+				ringGroups[slot] = wordGroups.get(lowerWord, ())
+				for groupIndex in ringGroups[slot]:
+					if groupCounts[groupIndex] == 0:
+						coveredGroups += 1
+					groupCounts[groupIndex] += 1
+
+				#every query word is in this window, so it's the one we want
+				if coveredGroups == len(termGroups):
+					exitIndex = currentIndex
+					newBest = True
+			elif exitIndex is not None:
+				newBest = False
+
+			if newBest:
 				bestWordIndex = currentIndex
+				bestScore = score
+				keptFrom = max(currentIndex - self.maxWords, 0)
+				kept = TokenTable(text)
+				for index in xrange(keptFrom, currentIndex + 1):
+					keptSlot = index % ringSize
+					kept.append(ringStarts[keptSlot], ringTailStarts[keptSlot], ringTailEnds[keptSlot],
+							ringFlags[keptSlot], ringScores[keptSlot])
+				stillFollowing = self.maxWords
+			elif stillFollowing > 0:
+				kept.append(start, tailStart, tailEnd, flags, score)
+				stillFollowing -= 1
+
+			if streamed:
+				#once the kept words are complete, copy out their text so the stream can drop it
+				if stillFollowing == 0 and kept.doc is document:
+					kept = self._keepStreamText(kept)
+
+				#a new best word would need the words from maxWords back
+				oldestNeeded = currentIndex + 1 - self.maxWords
+				document.keepFrom = ringStarts[oldestNeeded % ringSize] if oldestNeeded > 0 else 0
+				if kept.doc is document:
+					document.keepFrom = min(document.keepFrom, kept.starts[0])
+
+			#once we've kept enough words to finish the exit window's snippet, we're done
+			if exitIndex is not None and stillFollowing == 0:
+				break
+
+			currentIndex += 1
+
+		if streamed and kept.doc is document:
+			kept = self._keepStreamText(kept)
+
+		return kept, bestWordIndex - keptFrom
+
+	def buildMatchScores(self, document, matchPositions):
+		"""Scores a TokenizedDocument exactly like buildWordScores, visiting only the words near matches
+
+		A word's score is 0 unless a match came shortly before it: each match adds maxWords
+		and every other word takes at least one away. Once the score is back at 0, it stays
+		there until the next match. So we jump from match to match and only run the scores
+		for as long as they stay above 0, and the cost depends on the number of matches and
+		maxWords rather than on the length of the document.
+
+		args:
+			document -- a TokenizedDocument
+			matchPositions -- the sorted positions of the words which match the query
+
+		Returns a TokenTable holding just the words around the best word, and the index of
+		the best word in it, like scanWordScores"""
+		maxWords = self.maxWords
+		wordCount = len(document)
+		scores, bestWordIndex = self.scoreMatchPositions(matchPositions, wordCount)
+
+		#keep the words findBestSnippet might look at, like scanWordScores
+		keptFrom = max(bestWordIndex - maxWords, 0)
+		keptTo = min(bestWordIndex + maxWords + 1, wordCount)
+		matching = frozenset(matchPositions[bisect.bisect_left(matchPositions, keptFrom):
+				bisect.bisect_left(matchPositions, keptTo)])
+
+		table = TokenTable(document.doc)
+		for index in xrange(keptFrom, keptTo):
+			flags = document.flags[index] | (TokenTable.MATCHING if index in matching else 0)
+			table.append(document.starts[index], document.tailStarts[index], document.tailEnds[index],
+					flags, scores.get(index, 0))
 
-		#and vioala!
-		return words, bestWordIndex
+		return table, bestWordIndex - keptFrom
 
-	def findBestSnippet(self, words, bestWordIndex):
-		"""Build a snippet around the word with the best score"""
+	def scoreMatchTable(self, table, matchPositions):
+		"""Scores a match table (see buildMatchTable) with the decaying scores of buildWordScores
+
+		The scores of words away from any match are 0, so only the words near the matches
+		are visited. Returns a copy of the table with the scores, and the index of the best word"""
+		scores = array('i', [0]) * len(table)
+		sparseScores, bestWordIndex = self.scoreMatchPositions(matchPositions, len(table))
+		for position, score in sparseScores.items():
+			scores[position] = score
+		return table.scored(scores), bestWordIndex
+
+	def scoreMatchPositions(self, matchPositions, wordCount):
+		"""Runs the decaying scores of buildWordScores from just the positions of the matches
+
+		See buildMatchScores. Returns {position: score} for the words whose score isn't 0,
+		and the position of the best word"""
+		maxWords = self.maxWords
+		scores = {}
+		bestWordIndex = 0
+		bestScore = 0
+
+		nextMatch = 0
+		while nextMatch < len(matchPositions):
+			position = matchPositions[nextMatch]
+			score = 0			#the word before the match, which we skipped
+
+			#run the scores from this match until they decay to nothing
+			while position < wordCount:
+				if nextMatch < len(matchPositions) and matchPositions[nextMatch] == position:
+					#matching words jump score by the snippet size
+					score = score + maxWords if position > 0 else 0
+					nextMatch += 1
+				elif score == 0:
+					break
+				else:
+					score -= 1
+
+				#we want to eliminate the influence of words which don't even make it into this window
+				score = max(score - scores.get(position - maxWords, 0), 0)
+				if score:
+					scores[position] = score
+				if score > bestScore:
+					bestWordIndex = position
+					bestScore = score
+
+				position += 1
+
+		return scores, bestWordIndex
+
+	def _keepStreamText(self, table):
+		"""Copies the text of a table's words out of its TextStream"""
+		if len(table) == 0:
+			return TokenTable('')
+
+		origin = table.starts[0]
+		return table.rebased(table.doc.text(origin, table.tailEnds[-1]), origin)
+
+	def findBestSnippet(self, table, bestWordIndex):
+		"""Build a snippet around the word with the best score
+
+		Returns the (firstIndex, lastIndex) slice of the table which makes up the snippet"""
 		#we always add one to bestWordIndex because we want this item to make it into the slicing
 		bestWordIndex += 1
 		#figure out where the snippet starts
@@ -135,16 +1383,14 @@ class Snipper(object):
 			#we might be able to  sacrifice some words from the front of the string
 			#to get a clause start at the front of the snippet
 			for cutFromFront in xrange(self.maxWords):
-				prevWord = words[minFirstIndex + cutFromFront - 1]
-				curWord = words[minFirstIndex + cutFromFront]
+				prevIndex = minFirstIndex + cutFromFront - 1
 
-				#normally, the score decays by one each word. If the next word has a bigger
-				#score than the previous word, it's a matching word and cannot be cut
-				if prevWord['score'] < curWord['score']:
+				#matching words cannot be cut
+				if self.scoring.keepsWord(table, prevIndex + 1):
 					break
 
 				#if the prev word is a clause ender, we cut here
-				if prevWord['clauseEnder']:
+				if table.clauseEnder(prevIndex):
 					break
 
 			firstIndex = minFirstIndex + cutFromFront
@@ -152,7 +1398,7 @@ class Snipper(object):
 			#if we didn't find the beginning of the clause, we want to give a bit of a buffer
 			#to the best word. Try to give at least minPreceedingWords unless that puts the
 			#snippet over maxWords
-			if not prevWord['clauseEnder']:
+			if not table.clauseEnder(prevIndex):
 				preceedingWords = bestWordIndex - firstIndex
 				if cutFromFront > 0 and preceedingWords < self.minPreceedingWords:
 					neededWords = self.minPreceedingWords - preceedingWords
@@ -172,26 +1418,63 @@ class Snipper(object):
 		#if we have space in our snippet, we might could try to find the end of the clause
 		lastIndex = bestWordIndex
 		if cutFromFront > 0:
-			try:
-				for addToEnd in xrange(0, cutFromFront + 1):
-					curWord = words[lastIndex + addToEnd]
-					if curWord['clauseEnder']:
-						addToEnd += 1	#make sure to enclude the last word
-						break
-			except IndexError:
-				pass			#ran out of words
+			for addToEnd in xrange(0, cutFromFront + 1):
+				if lastIndex + addToEnd >= len(table):
+					break		#ran out of words
+
+				if table.clauseEnder(lastIndex + addToEnd):
+					addToEnd += 1	#make sure to enclude the last word
+					break
 
 			lastIndex = lastIndex + addToEnd
 
 		#and now, for the grande finale
-		return words[firstIndex:lastIndex]
+		return firstIndex, min(lastIndex, len(table))
+
+	def buildQueryTermGroups(self, query):
+		"""Builds one set of matching words per distinct word of the query string
+
+		Together the groups hold the same words as buildQueryWordList(query); they
+		tell us which of the query's words a matching document word stands for"""
+		groups = []
+		for queryWord in normalizeQuery(query).split():
+			group = self.buildQueryWordList(queryWord)
+			if group not in groups:
+				groups.append(group)
+
+		return groups
+
+	def buildWordGroups(self, termGroups):
+		"""Returns {word: [groupIndex, ...]}, the indexes of the term groups (see
+		buildQueryTermGroups) each matching word is in"""
+		wordGroups = {}
+		for groupIndex, group in enumerate(termGroups):
+			for term in group:
+				wordGroups.setdefault(term, []).append(groupIndex)
+		return wordGroups
 
 	def buildQueryWordList(self, query):
-		"""Builds a list of matching words from the query string
+		"""Builds the set of matching words from the query string
+
+		Expansions made with the default lexicon are kept in queryCache, so repeated
+		queries are only expanded once per process"""
+		if self._lexicon is not None:
+			return self.expandQuery(query)
+
+		query = normalizeQuery(query)
+		queryWords = queryCache.get(query)
+		if queryWords is None:
+			queryWords = self.expandQuery(query)
+			queryCache.put(query, queryWords)
+
+		return queryWords
+
+	def expandQuery(self, query):
+		"""Expands the query string into the set of words it should match
 
 		we use a basic stemming algorithm which isn't very sophisicated
 		but should be better than nothing"""
-		import words
+		knownWords = self.lexicon
 
 		suffixes = ['s', 'ing', 'est', 'ed', 'er', 'dom', 'like', 'ish', 'ly', 'ness', 'y', 'ism']
 		queryWords = query.split()
@@ -199,13 +1482,13 @@ class Snipper(object):
 		finalWords = []
 
 		for queryWord in queryWords:
-			if queryWord in words.words:
+			if queryWord in knownWords:
 				baseWords.append(queryWord)
 
 				for suffix in suffixes:
 					if queryWord.endswith(suffix):
 						baseWord = queryWord[0:queryWord.rfind(suffix)]
-						if baseWord in words.words:
+						if baseWord in knownWords:
 							baseWords.append(baseWord)
 
 			#always keep the query word	
@@ -215,47 +1498,62 @@ class Snipper(object):
 		for baseWord in baseWords:
 			for suffix in suffixes:
 				finalWord = baseWord + suffix
-				if finalWord in words.words:
+				if finalWord in knownWords:
 					finalWords.append(finalWord)
 
 			#always keep the base word
 			finalWords.append(baseWord)
 
 		#we may have gotten dupes when we saved the queryWord AND a finalWord
-		finalWords = [word.lower() for word in set(finalWords)]
-		return finalWords
+		return frozenset(word.lower() for word in finalWords)
 
-	def highlightSnippet(self, snippetWords):
+	def highlightSnippet(self, table, firstIndex, lastIndex):
 		"""Highlights words in a document
 		Args:
-			snippetWords -- a list of words which comprise the snippet (from buildWordScores)
+			table -- the token table of the document (from buildWordScores)
+			firstIndex, lastIndex -- the slice of the table which comprises the snippet
 		returns
 			A string with the matching words from the query highlighted"""
 
-		highlightedSnippet = ""
-		alreadyHighlighting = False
+		doc = table.doc
+		starts, tailStarts = table.starts, table.tailStarts
+		parts = []
+		copiedUpTo = table.snippetStart(firstIndex, lastIndex)	#how much of the doc we've copied so far
 
-		for index in xrange(len(snippetWords)):
-			snippetWord = snippetWords[index]
-			if snippetWord['matching'] and not alreadyHighlighting:
-				highlightedSnippet += "[[HIGHLIGHT]]"
-				alreadyHighlighting = True
+		#consecutive matching words share one highlight, and everything between
+		#highlights is copied in a single slice
+		for runStart, runEnd in table.matchRuns(firstIndex, lastIndex):
+			parts.append(doc[copiedUpTo:starts[runStart]])
+			parts.append("[[HIGHLIGHT]]")
+			parts.append(doc[starts[runStart]:tailStarts[runEnd - 1]])
+			parts.append("[[ENDHIGHLIGHT]]")
+			copiedUpTo = tailStarts[runEnd - 1]
 
-			highlightedSnippet += snippetWord['originalWord']
+		parts.append(doc[copiedUpTo:table.snippetEnd(firstIndex, lastIndex)])
+		return "".join(parts).strip()
 
-			if alreadyHighlighting:
-				try:
-					nextWord = snippetWords[index + 1]
-				except IndexError:
-					nextWord = None
+def warmup():
+	"""Loads everything snippet highlighting needs ahead of the first query
 
-				if not nextWord or not nextWord['matching']:
-					highlightedSnippet += "[[ENDHIGHLIGHT]]"
-					alreadyHighlighting = False
+	Pre-fork servers should call this before forking so that workers share the loaded
+	state instead of loading it while serving their first request.
 
-			highlightedSnippet += snippetWord['tail']
+	Returns:
+		The lexicon load statistics, see lexicon.LexiconRegistry.stats"""
+	lexicon.registry.warmup()
+	return lexicon.registry.stats()
 
-		return highlightedSnippet.strip()
+def lexiconStats():
+	"""Returns whether, when and how the process-wide lexicon was loaded"""
+	return lexicon.registry.stats()
+
+def queryCacheStats():
+	"""Returns the size and hit, miss and eviction counts of the query expansion cache"""
+	return queryCache.stats()
+
+def setQueryCacheSize(maxSize):
+	"""Sets how many expanded queries are kept, evicting the least recently used if needed"""
+	queryCache.maxSize = maxSize
 
 def highlightDoc(doc, query):
 	"""Highlights snippets in a document
@@ -268,3 +1566,229 @@ def highlightDoc(doc, query):
 
 	snipper = Snipper(doc, query)
 	return snipper.bestSnippetHighlighted
+
+def highlightDocs(docs, query, **options):
+	"""Highlights snippets in many documents for the same query
+	Args:
+		docs -- the documents to be highlighted
+		query -- the search string
+		options -- passed on to Snipper, eg maxWords
+
+	Returns:
+		A list with the highlighted snippet of each document, in order.
+
+	A single snipper is pointed at each document in turn, so the query is only
+	expanded once for the whole batch"""
+
+	snipper = Snipper('', query, **options)
+	highlighted = []
+	for doc in docs:
+		snipper.doc = doc
+		highlighted.append(snipper.bestSnippetHighlighted)
+
+	return highlighted
+
+def densestWindow(positions, windowSize):
+	"""Finds the window of windowSize consecutive words holding the most of the given positions
+
+	Args:
+		positions -- sorted word positions, eg of the words matching a query
+		windowSize -- how many words the window spans
+	Returns:
+		(count, firstPosition) -- how many positions the densest window holds and the first of
+		them; the earliest window wins ties, and (0, None) means there were no positions"""
+	best = (0, None)
+	left = 0
+	for right in xrange(len(positions)):
+		#drop positions which fell out of a window ending at this one
+		while positions[right] - positions[left] >= windowSize:
+			left += 1
+
+		if right - left + 1 > best[0]:
+			best = (right - left + 1, positions[left])
+
+	return best
+
+class SnippetIndex(object):
+	"""An in-process index for finding and snipping the documents which match a query
+
+	Each document is tokenized once when it's added, and every term maps to the positions
+	it occurs at in each document. A query is expanded just as Snipper expands it, so a
+	search only looks up the postings of the expanded words rather than scanning any
+	documents, and documents are ranked by how many matches fit in their densest window"""
+
+	def __init__(self, maxWords = 60, minPreceedingWords = 5, lexicon = None, tokenizer = None):
+		"""Args:
+			maxWords -- the size of a snippet, and of the window documents are ranked by
+			minPreceedingWords, lexicon, tokenizer -- as for Snipper"""
+		self.tokenizer = tokenizer or defaultTokenizer
+		self._documents = {}		#docId -> TokenizedDocument
+		self._added = {}			#docId -> when it was added, to break ties between equal matches
+		self._postings = {}			#term -> {docId: array of positions}
+		self._nextDocId = 0
+		self._additions = 0
+
+		#a single snipper expands queries and snips documents, like highlightDocs. Streaming
+		#makes it score the documents from their match positions (see buildMatchScores)
+		self._snipper = Snipper('', '', maxWords, minPreceedingWords, lexicon, streaming = True,
+				tokenizer = self.tokenizer)
+
+	@property
+	def maxWords(self):
+		return self._snipper.maxWords
+
+	def __len__(self):
+		return len(self._documents)
+
+	def __contains__(self, docId):
+		return docId in self._documents
+
+	def document(self, docId):
+		"""Returns the TokenizedDocument for docId"""
+		return self._documents[docId]
+
+	def addDocument(self, doc, docId = None):
+		"""Adds a document to the index
+
+		Args:
+			doc -- the document text, a MappedDocument, or an already TokenizedDocument
+			docId -- how the document is referred to; defaults to the next unused number
+		Returns:
+			The docId"""
+		if docId is None:
+			#numbers are never reused, even once their document is removed
+			while self._nextDocId in self._documents:
+				self._nextDocId += 1
+			docId = self._nextDocId
+			self._nextDocId += 1
+		if docId in self._documents:
+			raise ValueError("Document %r is already indexed" % (docId,))
+
+		if not isinstance(doc, TokenizedDocument):
+			doc = TokenizedDocument(doc, self.tokenizer)
+		self._documents[docId] = doc
+		self._added[docId] = self._additions
+		self._additions += 1
+
+		for termId, positions in doc.termPositions().items():
+			self._postings.setdefault(doc.term(termId), {})[docId] = positions
+
+		return docId
+
+	def removeDocument(self, docId):
+		"""Drops a document and its postings from the index"""
+		doc = self._documents.pop(docId)
+		del self._added[docId]
+		for termId in set(doc.termIds):
+			term = doc.term(termId)
+			postings = self._postings[term]
+			del postings[docId]
+			if not postings:
+				del self._postings[term]
+
+	def matchPositions(self, query):
+		"""Returns {docId: sorted positions of the words matching the query} for every matching document"""
+		documentPositions = {}
+		for word in self._snipper.buildQueryWordList(query):
+			for docId, positions in self._postings.get(word, {}).items():
+				documentPositions.setdefault(docId, []).extend(positions)
+
+		for positions in documentPositions.values():
+			positions.sort()
+		return documentPositions
+
+	def search(self, query, limit = None):
+		"""Ranks the documents matching the query by their densest window of maxWords words
+
+		Returns:
+			A list of (docId, count) for at most limit documents, where count is how many
+			matching words the document's densest window holds. Documents which match
+			equally are listed in the order they were added"""
+		results = [(docId, densestWindow(positions, self.maxWords)[0])
+				for docId, positions in self.matchPositions(query).items()]
+		results.sort(key = lambda result: (-result[1], self._added[result[0]]))
+		return results[:limit] if limit is not None else results
+
+	def snippet(self, docId, query, highlighted = True):
+		"""Returns the best snippet of an indexed document, highlighted unless told otherwise"""
+		self._snipper.doc = self._documents[docId]
+		self._snipper.query = query
+		if highlighted:
+			return self._snipper.bestSnippetHighlighted
+		return self._snipper.bestSnippet
+
+	def highlight(self, query, limit = None):
+		"""Returns [(docId, highlighted snippet)] for the best matching documents, best first"""
+		return [(docId, self.snippet(docId, query)) for docId, count in self.search(query, limit)]
+
+def _initWorker():
+	"""Runs once in each worker process, so the lexicon is loaded once per worker"""
+	warmup()
+
+def _highlightChunk(job):
+	docs, query, options = job
+	return highlightDocs(docs, query, **options)
+
+class ParallelSnipper(object):
+	"""Highlights large batches of documents across a pool of worker processes
+
+	Scoring is pure python, so one process can only use one core. Documents are
+	sent to the workers in chunks so that the cost of passing them between
+	processes is spread over many documents. Use as a context manager, or call
+	close() when done, to shut the workers down"""
+
+	#how many chunks per worker may be waiting to be highlighted
+	chunksInFlight = 2
+
+	def __init__(self, processes = None, chunkSize = 64):
+		"""Args:
+			processes -- how many workers to start; defaults to the number of cores
+			chunkSize -- how many documents to send to a worker at a time"""
+		self.chunkSize = chunkSize
+		self.processes = processes or multiprocessing.cpu_count()
+		self._pool = multiprocessing.Pool(self.processes, initializer = _initWorker)
+
+	def highlight(self, docs, query, **options):
+		"""Highlights snippets in many documents for the same query
+		Args:
+			docs -- the documents to be highlighted; any iterable. It is read as the workers
+				get through it, at most chunksInFlight chunks per worker ahead of them
+			query -- the search string
+			options -- passed on to Snipper, eg maxWords
+
+		Returns:
+			A list with the highlighted snippet of each document, in order."""
+		docs = iter(docs)
+		chunks = iter(lambda: list(itertools.islice(docs, self.chunkSize)), [])
+
+		#Pool.imap would read every chunk up front, so we submit them ourselves and wait
+		#for the oldest once enough are queued
+		highlighted = []
+		pending = deque()
+		for chunk in chunks:
+			pending.append(self._pool.apply_async(_highlightChunk, ((chunk, query, options),)))
+			if len(pending) >= self.chunksInFlight * self.processes:
+				highlighted.extend(pending.popleft().get())
+
+		while pending:
+			highlighted.extend(pending.popleft().get())
+
+		return highlighted
+
+	def close(self):
+		self._pool.close()
+		self._pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exception):
+		self.close()
+
+def highlightMany(docs, query, processes = None, chunkSize = 64, **options):
+	"""Highlights snippets in many documents for the same query using all cores
+
+	See ParallelSnipper; for repeated batches, keep a ParallelSnipper around instead
+	so the workers are only started once"""
+	with ParallelSnipper(processes, chunkSize) as parallel:
+		return parallel.highlight(docs, query, **options)
@@ -3,8 +3,18 @@
 #Unit tests file for highlights
 #http://www.yelp.com/search?find_desc=deep+dish+pizza&ns=1&rpp=10&find_loc=San+Francisco%2C+CA
 
-import unittest, random
-import snippets
+import unittest, random, os, tempfile, mmap
+import snippets, lexicon
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO		#python 3
+
+try:
+	xrange
+except NameError:
+	xrange = range
 
 class TestHighlights(unittest.TestCase):
 	"""Tests the highlights class for to make sure it works"""
@@ -51,6 +61,35 @@ class TestHighlights(unittest.TestCase):
 				s.bestSnippetHighlighted,
 				"[[HIGHLIGHT]]The quick brown fox jumped over a lazy dog[[ENDHIGHLIGHT]].")
 
+	def testManyDocuments(self):
+		"""Highlighting a batch should match highlighting each document alone"""
+		docs = ["The quick brown fox jumped over a lazy dog.",
+				"This document does not include the names of any mammals",
+				"",
+				"Foxes are not dogs. A fox is a fox."]
+
+		for query in ('fox', 'lazy dogs', 'the'):
+			self.assertEqual(snippets.highlightDocs(docs, query),
+					[snippets.highlightDoc(doc, query) for doc in docs])
+
+		self.assertEqual(snippets.highlightDocs(docs[-1:], 'fox', maxWords = 3),
+				["A [[HIGHLIGHT]]fox[[ENDHIGHLIGHT]] is"])
+
+	def testParallel(self):
+		"""Highlighting in worker processes should give results in the original order"""
+		docs = ["The quick brown fox jumped over a lazy dog.",
+				"This document does not include the names of any mammals",
+				"",
+				"Foxes are not dogs. A fox is a fox."] * 5
+
+		with snippets.ParallelSnipper(processes = 2, chunkSize = 3) as parallel:
+			self.assertEqual(parallel.highlight(docs, 'fox'), snippets.highlightDocs(docs, 'fox'))
+			self.assertEqual(parallel.highlight(iter(docs), 'lazy dogs', maxWords = 3),
+					snippets.highlightDocs(docs, 'lazy dogs', maxWords = 3))
+			self.assertEqual(parallel.highlight([], 'fox'), [])
+
+		self.assertEqual(snippets.highlightMany(docs, 'fox', processes = 2), snippets.highlightDocs(docs, 'fox'))
+
 	def testNoMatches(self):
 		"""Nothing should be highlighted if the document has no matching groups"""
 		doc = "This document does not include the names of any mammals"
@@ -117,11 +156,791 @@ class TestExtraction(unittest.TestCase):
 		s = snippets.Snipper(doc, 'relevant', maxWords = 3, minPreceedingWords = 0)
 		self.assertEqual(s.bestSnippet, "relevant sentence.")
 
+class TestMultipleSnippets(unittest.TestCase):
+	"""Tests extracting the k best snippets of a document"""
+	def testSingleIsBest(self):
+		"""Asking for one snippet should give the best snippet"""
+		commandline = open('command.txt').read()
+		for search in ('car wind', 'asteroid cherry', 'control freak'):
+			for size in (1, 10, 60):
+				s = snippets.Snipper(commandline, search, maxWords = size)
+				self.assertEqual(s.bestSnippets(1), s.bestSnippet)
+				self.assertEqual(s.bestSnippetsHighlighted(1), s.bestSnippetHighlighted)
+
+	def testNonOverlapping(self):
+		"""The snippets should not overlap, be in document order and each hold a match"""
+		commandline = open('command.txt').read()
+		for streaming in (False, True):
+			s = snippets.Snipper(commandline, 'car wind', maxWords = 20, streaming = streaming)
+			table, windows = s.getBestSnippetWindows(10)
+
+			self.assertEqual(len(windows), 10)
+			self.assertEqual(windows, sorted(windows))
+			for (firstIndex, lastIndex), (nextFirstIndex, nextLastIndex) in zip(windows, windows[1:]):
+				self.assertTrue(lastIndex <= nextFirstIndex)
+			for firstIndex, lastIndex in windows:
+				self.assertTrue(lastIndex - firstIndex <= 20)
+				self.assertTrue(table.matchRuns(firstIndex, lastIndex))
+
+	def testStreamedDocuments(self):
+		"""Streaming snippers score again in full, which a TextStream can't be read for"""
+		commandline = open('command.txt').read()
+		expected = snippets.Snipper(commandline, 'car wind', maxWords = 20).bestSnippets(3)
+		tokenized = snippets.TokenizedDocument(commandline)
+		self.assertEqual(snippets.Snipper(tokenized, 'car wind', maxWords = 20, streaming = True).bestSnippets(3), expected)
+
+		stream = snippets.TextStream([commandline[:1000], commandline[1000:]])
+		self.assertEqual(snippets.Snipper(stream, 'car wind', maxWords = 20).bestSnippets(3), expected)
+
+		stream = snippets.TextStream([commandline[:1000], commandline[1000:]])
+		s = snippets.Snipper(stream, 'car wind', maxWords = 20, streaming = True)
+		self.assertRaises(ValueError, s.bestSnippets, 3)
+
+		s = snippets.Snipper.fromStream(StringIO(commandline), 'car wind', maxWords = 20)
+		self.assertRaises(ValueError, s.bestSnippets, 3)
+
+	def testJoined(self):
+		doc = "Good pizza here. " + "Filler words go here. " * 5 + "More pizza. " + "Filler words go here. " * 5
+		s = snippets.Snipper(doc, 'pizza', maxWords = 3)
+		self.assertEqual(s.bestSnippets(2), "Good pizza here. ... More pizza. Filler")
+		self.assertEqual(s.bestSnippetsHighlighted(3, separator = " | "),
+				"Good [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]] here. | More [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]]. Filler")
+
+		#without any matches, there's only the beginning of the document
+		s = snippets.Snipper(doc, 'sushi', maxWords = 3)
+		self.assertEqual(s.bestSnippets(3), "Good pizza here.")
+
+class TestCoverageScoring(unittest.TestCase):
+	"""Tests scoring windows by how many distinct query words they hold"""
+	doc = "Pizza pizza pizza, we love pizza pizza. " + "Filler words. " * 10 + \
+			"The deep dish pizza was fine. " + "More filler. " * 10
+
+	def testCoverageBeatsRepeats(self):
+		"""A window with every query word should beat one with many matches of one"""
+		s = snippets.Snipper(self.doc, 'deep dish pizza', maxWords = 8)
+		self.assertTrue(s.bestSnippet.startswith("Pizza pizza pizza"))
+
+		s = snippets.Snipper(self.doc, 'deep dish pizza', maxWords = 8, scoring = 'coverage')
+		self.assertEqual(s.bestSnippetHighlighted, "Filler words. Filler words. The [[HIGHLIGHT]]deep dish pizza[[ENDHIGHLIGHT]]")
+
+	def testScores(self):
+		"""Covering another query word should count for more than any number of matches"""
+		s = snippets.Snipper("pizza dish pizza x x x deep", 'deep dish pizza', maxWords = 3, scoring = 'coverage')
+		table, bestWordIndex = s.getScoredWords()
+		self.assertEqual(list(table.scores), [5, 10, 11, 10, 5, 0, 5])
+		self.assertEqual(bestWordIndex, 2)
+
+	def testDocumentTypes(self):
+		"""Every kind of document should be scored the same"""
+		expected = snippets.Snipper(self.doc, 'deep dish pizza', maxWords = 8, scoring = 'coverage')
+		for doc in (snippets.TokenizedDocument(self.doc), snippets.TextStream([self.doc[:30], self.doc[30:]])):
+			s = snippets.Snipper(doc, 'deep dish pizza', maxWords = 8, scoring = 'coverage')
+			self.assertEqual(s.bestSnippetHighlighted, expected.bestSnippetHighlighted)
+
+	def testUnknownScoring(self):
+		self.assertRaises(ValueError, snippets.Snipper, self.doc, 'pizza', scoring = 'magic')
+
+class TestScoringStrategies(unittest.TestCase):
+	"""Tests picking how words are scored"""
+	def testByName(self):
+		"""Strategies can be picked by name or passed in, and decay scoring is the default"""
+		commandline = open('command.txt').read()
+		for search in ('car wind', 'control freak'):
+			expected = snippets.Snipper(commandline, search, maxWords = 20).bestSnippetHighlighted
+			for scoring in ('decay', snippets.DecayScoring()):
+				s = snippets.Snipper(commandline, search, maxWords = 20, scoring = scoring)
+				self.assertTrue(isinstance(s.scoring, snippets.DecayScoring))
+				self.assertEqual(s.bestSnippetHighlighted, expected)
+
+	def testCustomStrategy(self):
+		"""A custom strategy decides which word the snippet is built around"""
+		class LastWordScoring(snippets.ScoringStrategy):
+			def score(self, snipper):
+				table = snipper.buildMatchTable(snipper.doc, snipper.getQueryWords())
+				return table, len(table) - 1
+
+		s = snippets.Snipper("one two pizza four five six", 'pizza', maxWords = 2, scoring = LastWordScoring())
+		self.assertEqual(s.bestSnippet, "five six")
+
+		#a strategy has to score
+		class NoScoring(snippets.ScoringStrategy):
+			pass
+		self.assertRaises(TypeError, NoScoring)
+
+	def testWindowSums(self):
+		"""Window scores should count the matches among the last maxWords words"""
+		s = snippets.Snipper("pizza x pizza pizza x x x pizza", 'pizza', maxWords = 3,
+				scoring = snippets.WindowScoring('python'))
+		table, bestWordIndex = s.getScoredWords()
+		self.assertEqual(list(table.scores), [1, 1, 2, 2, 2, 1, 0, 1])
+		self.assertEqual(bestWordIndex, 2)
+		self.assertEqual(s.bestSnippetHighlighted, "[[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]] x [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]]")
+
+	@unittest.skipUnless(snippets.numpy, "numpy is not installed")
+	def testNumpyBackend(self):
+		"""The numpy backend should score exactly like the python one"""
+		commandline = open('command.txt').read()
+		tokenized = snippets.TokenizedDocument(commandline)
+		for search in ('car wind', 'the', 'zzz'):
+			for size in (1, 5, 60):
+				python = snippets.Snipper(tokenized, search, maxWords = size, scoring = snippets.WindowScoring('python'))
+				vectorized = snippets.Snipper(tokenized, search, maxWords = size, scoring = snippets.WindowScoring('numpy'))
+
+				table, bestWordIndex = python.getScoredWords()
+				vectorizedTable, vectorizedIndex = vectorized.getScoredWords()
+				self.assertEqual(list(vectorizedTable.scores), list(table.scores))
+				self.assertEqual(vectorizedIndex, bestWordIndex)
+				self.assertEqual(vectorized.bestSnippetHighlighted, python.bestSnippetHighlighted)
+
+	def testExactIsWindow(self):
+		"""'exact' names the window sums, which find exactly the window with the most matches"""
+		s = snippets.Snipper("pizza x pizza pizza x x x pizza", 'pizza', maxWords = 3, scoring = 'exact')
+		self.assertTrue(isinstance(s.scoring, snippets.WindowScoring))
+		self.assertEqual(s.getScoredWords()[1], 2)
+
+	def testBackends(self):
+		self.assertRaises(ValueError, snippets.WindowScoring, 'fortran')
+		if snippets.numpy is None:
+			self.assertRaises(ValueError, snippets.WindowScoring, 'numpy')
+			self.assertEqual(snippets.WindowScoring().backend, 'python')
+		else:
+			self.assertEqual(snippets.WindowScoring().backend, 'numpy')
+
+class TestStreaming(unittest.TestCase):
+	"""Tests scoring which only keeps the words around the best window"""
+	def testSameAsFullScoring(self):
+		"""Streaming should pick exactly the snippet full scoring picks"""
+		commandline = open('command.txt').read()
+		for search in ('car wind', 'asteroid cherry', 'control freak', 'making your own'):
+			for size in (1, 3, 10, 60):
+				full = snippets.Snipper(commandline, search, maxWords = size)
+				streamed = snippets.Snipper(commandline, search, maxWords = size, streaming = True)
+				self.assertEqual(full.bestSnippetHighlighted, streamed.bestSnippetHighlighted)
+
+				#we keep the best word plus maxWords on either side
+				table, bestWordIndex = streamed.getScoredWords()
+				self.assertTrue(len(table) <= 2 * size + 1)
+
+	def testEarlyExit(self):
+		"""Early exit should stop at the first window with every query word"""
+		doc = "Deep dish pizza is what we came for. " + "Filler words go here. " * 20 + \
+				"Pizza pizza pizza pizza pizza, pizza everywhere."
+
+		s = snippets.Snipper(doc, 'deep dish pizza', maxWords = 10)
+		self.assertTrue(s.bestSnippet.endswith("pizza pizza, pizza"))
+
+		s = snippets.Snipper(doc, 'deep dish pizza', maxWords = 10, earlyExit = True)
+		self.assertEqual(s.bestSnippetHighlighted,
+				"[[HIGHLIGHT]]Deep dish pizza[[ENDHIGHLIGHT]] is what we came for.")
+
+		#we only kept the words up to maxWords past the exit point
+		table, bestWordIndex = s.getScoredWords()
+		self.assertEqual(bestWordIndex, 2)
+		self.assertEqual(len(table), 13)
+
+	def testEarlyExitWithoutFullCoverage(self):
+		"""If no window has every query word, early exit should score the whole document"""
+		doc = "The quick brown fox jumped over a lazy dog."
+		s = snippets.Snipper(doc, 'fox cat', maxWords = 200, earlyExit = True)
+		self.assertEqual(s.bestSnippetHighlighted,
+				"The quick brown [[HIGHLIGHT]]fox[[ENDHIGHLIGHT]] jumped over a lazy dog.")
+
+	def testFromStream(self):
+		"""Reading a document in chunks should give the same snippets as reading it whole"""
+		doc = "This is an irrelevant sentence. This is a filler sentence. This is a relevant sentence."
+
+		for chunkSize in (1, 2, 3, 7, 50, 1000):
+			chunks = [doc[start:start + chunkSize] for start in xrange(0, len(doc), chunkSize)]
+			for size in (3, 6, 200):
+				expected = snippets.Snipper(doc, 'relevant', maxWords = size).bestSnippetHighlighted
+
+				s = snippets.Snipper.fromStream(chunks, 'relevant', maxWords = size)
+				self.assertEqual(s.bestSnippetHighlighted, expected)
+
+				s = snippets.Snipper.fromStream(StringIO(doc), 'relevant', maxWords = size,
+						chunkSize = chunkSize)
+				self.assertEqual(s.bestSnippetHighlighted, expected)
+
+	def testFromStreamKeepsLittleText(self):
+		"""Only the text around the best window should be kept from a stream"""
+		commandline = open('command.txt').read()
+		for search in ('car wind', 'control freak'):
+			expected = snippets.Snipper(commandline, search, maxWords = 10)
+			s = snippets.Snipper.fromStream(open('command.txt'), search, maxWords = 10, chunkSize = 4096)
+
+			self.assertEqual(s.bestSnippetHighlighted, expected.bestSnippetHighlighted)
+			self.assertTrue(len(s.doc) < 1000)
+
+	def testReadOnce(self):
+		"""A stream which has been read can't be scored again"""
+		commandline = open('command.txt').read()
+		chunks = [commandline[start:start + 4096] for start in xrange(0, len(commandline), 4096)]
+
+		stream = snippets.TextStream(chunks)
+		s = snippets.Snipper(stream, 'car wind', maxWords = 20, streaming = True)
+		self.assertEqual(s.bestSnippet, snippets.Snipper(commandline, 'car wind', maxWords = 20).bestSnippet)
+		self.assertRaises(ValueError, list, stream.words())
+
+		s.query = 'operating system'
+		self.assertRaises(ValueError, getattr, s, 'bestSnippet')
+
+	def testFromStreamKeepsQuery(self):
+		"""A snipper built from a stream only has the text around its best window, so the
+		doc and query can't change"""
+		s = snippets.Snipper.fromStream(StringIO(open('command.txt').read()), 'car wind', maxWords = 20)
+		expected = s.bestSnippet
+
+		s.query = 'car wind'
+		self.assertRaises(ValueError, setattr, s, 'query', 'operating system')
+		self.assertRaises(ValueError, setattr, s, 'doc', "operating system")
+		self.assertEqual(s.bestSnippet, expected)
+
+	def testTermGroups(self):
+		"""Each query word should get its own group of matching words"""
+		s = snippets.Snipper('', 'pizza  dish pizza')
+		groups = s.buildQueryTermGroups(s.query)
+		self.assertEqual(len(groups), 2)
+		self.assertTrue('pizzas' in groups[0] and 'dished' in groups[1])
+		self.assertEqual(groups[0] | groups[1], s.buildQueryWordList(s.query))
+
+class TestTokenizedDocuments(unittest.TestCase):
+	"""Tests snipping documents which were split into words ahead of time"""
+	def testSameAsString(self):
+		"""A tokenized document should give the same snippets as its text, for every query"""
+		commandline = open('command.txt').read()
+		tokenized = snippets.TokenizedDocument(commandline)
+
+		s = snippets.Snipper(tokenized, '')
+		for search in ('car wind', 'asteroid cherry', 'control freak', 'making your own'):
+			for size in (1, 3, 10, 60):
+				expected = snippets.Snipper(commandline, search, maxWords = size).bestSnippetHighlighted
+
+				s.query, s.maxWords = search, size
+				self.assertEqual(s.bestSnippetHighlighted, expected)
+
+				streamed = snippets.Snipper(tokenized, search, maxWords = size, streaming = True)
+				self.assertEqual(streamed.bestSnippetHighlighted, expected)
+
+	def testMatchScores(self):
+		"""Scoring from the match positions should keep the same words and scores as streaming"""
+		commandline = open('command.txt').read()
+		tokenized = snippets.TokenizedDocument(commandline)
+
+		for search in ('car wind', 'the', 'zzz'):
+			for size in (1, 5, 60):
+				s = snippets.Snipper(tokenized, search, maxWords = size)
+				positions = tokenized.matchPositions(s.buildQueryWordList(search))
+				table, bestWordIndex = s.buildMatchScores(tokenized, positions)
+
+				streamed = snippets.Snipper(commandline, search, maxWords = size, streaming = True)
+				expected, expectedIndex = streamed.getScoredWords()
+				self.assertEqual(bestWordIndex, expectedIndex)
+				self.assertEqual(list(table.scores), list(expected.scores))
+				self.assertEqual(list(table.flags), list(expected.flags))
+				self.assertEqual(list(table.starts), list(expected.starts))
+
+	def testMatchPositions(self):
+		tokenized = snippets.TokenizedDocument("Pizza and more pizza. And PIZZA")
+		self.assertEqual(tokenized.matchPositions(frozenset(['pizza', 'more'])), [0, 2, 3, 5])
+		self.assertEqual(tokenized.matchPositions(frozenset(['sushi'])), [])
+
+	def testVocabulary(self):
+		"""Each distinct word should be stored once, lowercased"""
+		tokenized = snippets.TokenizedDocument("Pizza and more pizza. And PIZZA")
+		self.assertEqual(tokenized.terms, ['pizza', 'and', 'more'])
+		self.assertEqual(list(tokenized.termIds), [0, 1, 2, 0, 1, 0])
+		self.assertEqual([word[4] for word in tokenized.words()], [False, False, False, True, False, False])
+		self.assertEqual(tokenized.matchingTermIds(frozenset(['pizza', 'dish'])), frozenset([0]))
+
+	def testCustomTokenizer(self):
+		"""The document should be split by the tokenizer it's given"""
+		tokenizer = snippets.Tokenizer(wordCharacters = "a-z0-9'`\"-")
+		tokenized = snippets.TokenizedDocument("we ate deep-dish pizza", tokenizer)
+		s = snippets.Snipper(tokenized, 'deep-dish')
+		self.assertEqual(s.bestSnippetHighlighted, "we ate [[HIGHLIGHT]]deep-dish[[ENDHIGHLIGHT]] pizza")
+
+	def testSaveAndLoad(self):
+		"""A saved and mapped token table should give the same snippets as the text"""
+		commandline = open('command.txt').read()
+		handle, path = tempfile.mkstemp()
+		os.close(handle)
+		try:
+			snippets.TokenizedDocument(commandline).save(path)
+			with snippets.MappedTokenizedDocument(path, commandline) as loaded:
+				for search in ('car wind', 'control freak', 'making your own', 'zzz'):
+					for streaming in (False, True):
+						expected = snippets.Snipper(commandline, search, maxWords = 30)
+						s = snippets.Snipper(loaded, search, maxWords = 30, streaming = streaming)
+						self.assertEqual(s.bestSnippetHighlighted, expected.bestSnippetHighlighted)
+		finally:
+			os.remove(path)
+
+	def testSavedTerms(self):
+		"""The saved terms should be sorted, with the word ids pointing at them"""
+		doc = "Pizza and more pizza. And PIZZA"
+		handle, path = tempfile.mkstemp()
+		os.close(handle)
+		try:
+			snippets.TokenizedDocument(doc).save(path)
+			with snippets.MappedTokenizedDocument(path, doc) as loaded:
+				self.assertEqual(loaded.terms, ['and', 'more', 'pizza'])
+				self.assertEqual(list(loaded.termIds), [2, 0, 1, 2, 0, 2])
+				self.assertEqual([word[4] for word in loaded.words()], [False, False, False, True, False, False])
+				self.assertEqual(loaded.termId('more'), 1)
+				self.assertEqual(loaded.termId('less'), None)
+				self.assertEqual(loaded.matchingTermIds(frozenset(['pizza', 'dish'])), frozenset([2]))
+		finally:
+			os.remove(path)
+
+	def testLoadChecks(self):
+		"""Loading should refuse files which aren't token tables, or were saved for another document"""
+		doc = "Pizza and more pizza"
+		handle, path = tempfile.mkstemp()
+		os.write(handle, b'not a token table at all')
+		os.close(handle)
+		try:
+			self.assertRaises(ValueError, snippets.MappedTokenizedDocument, path, doc)
+
+			snippets.TokenizedDocument(doc).save(path)
+			self.assertRaises(ValueError, snippets.MappedTokenizedDocument, path, doc + " and more")
+		finally:
+			os.remove(path)
+
+	def testTruncated(self):
+		"""Loading should refuse a token table which has lost its end"""
+		doc = "Pizza and more pizza"
+		handle, path = tempfile.mkstemp()
+		os.close(handle)
+		try:
+			snippets.TokenizedDocument(doc).save(path)
+			size = os.path.getsize(path)
+			snippets.MappedTokenizedDocument(path, doc).close()
+
+			#cut into the term data, the columns and the header
+			for length in (size - 1, size // 2, 10):
+				with open(path, 'r+b') as tokensFile:
+					tokensFile.truncate(length)
+				self.assertRaises(ValueError, snippets.MappedTokenizedDocument, path, doc)
+		finally:
+			os.remove(path)
+
+class TestSnippetIndex(unittest.TestCase):
+	"""Tests finding and snipping documents through the positional index"""
+	def setUp(self):
+		self.docs = [
+				"Nothing to see here, just a review of a nail salon.",
+				"The pizza was fine. Later we talked about pizza for hours, then had more pizza.",
+				"Deep dish pizza, pizza everywhere, pizza pizzas!",
+				]
+		self.index = snippets.SnippetIndex(maxWords = 6)
+		for doc in self.docs:
+			self.index.addDocument(doc)
+
+	def testSearch(self):
+		"""Documents should be ranked by the most matches in any window of maxWords words"""
+		self.assertEqual(self.index.search('pizza'), [(2, 4), (1, 1)])
+		self.assertEqual(self.index.search('pizza', limit = 1), [(2, 4)])
+		self.assertEqual(self.index.search('salon nail'), [(0, 2)])
+		self.assertEqual(self.index.search('sushi'), [])
+
+	def testSnippet(self):
+		"""Snippets from the index should be the ones Snipper finds in the text"""
+		for docId, doc in enumerate(self.docs):
+			for search in ('pizza', 'nail', 'deep dish'):
+				expected = snippets.Snipper(doc, search, maxWords = 6)
+				self.assertEqual(self.index.snippet(docId, search), expected.bestSnippetHighlighted)
+				self.assertEqual(self.index.snippet(docId, search, highlighted = False), expected.bestSnippet)
+
+		self.assertEqual(self.index.highlight('deep dish'),
+				[(2, "[[HIGHLIGHT]]Deep dish[[ENDHIGHLIGHT]] pizza, pizza everywhere, pizza")])
+
+	def testAddAndRemove(self):
+		"""Documents can be added under their own ids and removed again"""
+		self.assertRaises(ValueError, self.index.addDocument, "again", 1)
+		self.assertEqual(self.index.addDocument(snippets.TokenizedDocument("sushi, not pizza"), 'sushi'), 'sushi')
+		self.assertEqual(self.index.search('sushi'), [('sushi', 1)])
+
+		self.index.removeDocument(2)
+		self.assertEqual(self.index.search('pizza'), [(1, 1), ('sushi', 1)])
+		self.assertFalse(2 in self.index)
+		self.assertEqual(self.index.addDocument("more pizza"), 3)
+
+	def testDensestWindow(self):
+		self.assertEqual(snippets.densestWindow([], 5), (0, None))
+		self.assertEqual(snippets.densestWindow([3], 5), (1, 3))
+		self.assertEqual(snippets.densestWindow([0, 4, 5, 9, 10, 11], 5), (3, 9))
+		self.assertEqual(snippets.densestWindow([0, 4, 5, 9, 10, 11], 2), (2, 4))
+
+class TestMappedDocuments(unittest.TestCase):
+	"""Tests snippets taken straight out of memory-mapped files"""
+	def testSameAsString(self):
+		"""A mapped file should give the same snippets as its text"""
+		commandline = open('command.txt', 'rb').read().decode('utf-8')
+		for search in ('car wind', 'asteroid cherry', 'making your own'):
+			for streaming in (False, True):
+				expected = snippets.Snipper(commandline, search, maxWords = 30)
+				with snippets.Snipper.fromFile('command.txt', search, maxWords = 30, streaming = streaming) as s:
+					self.assertEqual(s.bestSnippetHighlighted, expected.bestSnippetHighlighted)
+					self.assertEqual(s.bestSnippet, expected.bestSnippet)
+				self.assertRaises(ValueError, s.doc.map.read, 1)
+
+	def testEncoding(self):
+		"""Snippets should be decoded using the declared encoding"""
+		doc = u"Caf\xe9 cr\xe8me br\xfbl\xe9e; the cr\xe8me is good"
+		for encoding in ('utf-8', 'latin-1'):
+			handle, path = tempfile.mkstemp()
+			os.write(handle, doc.encode(encoding))
+			os.close(handle)
+			try:
+				with open(path, 'rb') as documentFile:
+					documentMap = mmap.mmap(documentFile.fileno(), 0, access = mmap.ACCESS_READ)
+				s = snippets.Snipper.fromFile(documentMap, 'good', 5, encoding = encoding)
+				self.assertEqual(s.bestSnippetHighlighted,
+						u"the cr\xe8me is [[HIGHLIGHT]]good[[ENDHIGHLIGHT]]")
+				self.assertEqual(s.getBestSnippetWords(), [u'the', u'cr', u'me', u'is', u'good'])
+				s.doc.close()
+			finally:
+				os.remove(path)
+
+	def testEmptyFile(self):
+		"""An empty file can't be mapped, but should snip like an empty document"""
+		handle, path = tempfile.mkstemp()
+		os.close(handle)
+		try:
+			with snippets.MappedDocument(path) as document:
+				self.assertEqual(len(document), 0)
+				self.assertEqual(snippets.Snipper(document, 'pizza').bestSnippetHighlighted, "")
+		finally:
+			os.remove(path)
+
+class TestTokenTable(unittest.TestCase):
+	"""Tests the columnar table of scored words"""
+	def testRows(self):
+		"""Each row should point back at its word and tail in the document"""
+		doc = "  Deep dish; pizza. Yum"
+		s = snippets.Snipper(doc, 'pizza')
+		table, bestWordIndex = s.getScoredWords()
+
+		self.assertEqual(len(table), 4)
+		self.assertEqual([table.originalWord(i) for i in xrange(4)], ['Deep', 'dish', 'pizza', 'Yum'])
+		self.assertEqual([table.word(i) for i in xrange(4)], ['deep', 'dish', 'pizza', 'yum'])
+		self.assertEqual([table.tail(i) for i in xrange(4)], [' ', '; ', '. ', ''])
+		self.assertEqual([table.clauseEnder(i) for i in xrange(4)], [False, True, True, False])
+		self.assertEqual([table.matching(i) for i in xrange(4)], [False, False, True, False])
+		self.assertEqual(bestWordIndex, 2)
+		self.assertEqual(s.getBestSnippetWords(), ['Deep', 'dish', 'pizza', 'Yum'])
+
+		self.assertEqual(table.snippet(1, 3), "dish; pizza. ")
+		self.assertEqual(table.snippet(2, 2), "")
+		self.assertEqual(s.highlightSnippet(table, 1, 3), "dish; [[HIGHLIGHT]]pizza[[ENDHIGHLIGHT]].")
+
+	def testMatchRuns(self):
+		"""Consecutive matching words should form a single run, cut off at the window"""
+		s = snippets.Snipper("deep dish pizza is not thin crust pizza", 'deep dish pizza')
+		table, bestWordIndex = s.getScoredWords()
+
+		self.assertEqual(table.matchRuns(0, len(table)), [(0, 3), (7, 8)])
+		self.assertEqual(table.matchRuns(1, 2), [(1, 2)])
+		self.assertEqual(table.matchRuns(3, 7), [])
+		self.assertEqual(s.highlightSnippet(table, 1, 2), "[[HIGHLIGHT]]dish[[ENDHIGHLIGHT]]")
+
+class TestTokenizer(unittest.TestCase):
+	"""Tests splitting documents into words"""
+	def testDefault(self):
+		"""The tokenizer should find each word, its tail and whether it ends a clause"""
+		words = list(snippets.defaultTokenizer.words("  Deep dish; pizza. Yum"))
+		self.assertEqual(words, [(2, 6, 7, 'Deep', False), (7, 11, 13, 'dish', True),
+				(13, 18, 20, 'pizza', True), (20, 23, 23, 'Yum', False)])
+
+	def testCustomCharacters(self):
+		"""Custom word and clause characters should change both the words and the snippet rounding"""
+		tokenizer = snippets.Tokenizer(wordCharacters = "a-z0-9'`\"-", clauseCharacters = ".;!")
+		self.assertEqual([word[3] for word in tokenizer.words("a deep-dish pizza")], ['a', 'deep-dish', 'pizza'])
+		self.assertEqual([word[4] for word in tokenizer.words("wow! pizza")], [True, False])
+
+		doc = "one two three! four five pizza six"
+		s = snippets.Snipper(doc, 'pizza', maxWords = 4, minPreceedingWords = 2, tokenizer = tokenizer)
+		self.assertEqual(s.bestSnippet, "four five pizza six")
+		s = snippets.Snipper(doc, 'pizza', maxWords = 4, minPreceedingWords = 2)
+		self.assertNotEqual(s.bestSnippet, "four five pizza six")
+
+	def testFromStream(self):
+		"""Streamed documents should be split by the snipper's tokenizer"""
+		tokenizer = snippets.Tokenizer(wordCharacters = "a-z0-9'`\"-")
+		doc = "we ate some deep-dish pizza today " * 10
+		s = snippets.Snipper.fromStream(StringIO(doc), 'deep-dish', tokenizer = tokenizer, chunkSize = 7)
+		self.assertTrue("[[HIGHLIGHT]]deep-dish[[ENDHIGHLIGHT]]" in s.bestSnippetHighlighted)
+
+class TestLexicon(unittest.TestCase):
+	"""Tests the dictionary used to expand queries"""
+	def testMembership(self):
+		"""The default lexicon should know everything in words.py"""
+		import words
+		knownWords = lexicon.defaultLexicon()
+		self.assertEqual(len(knownWords), len(set(words.words)))
+		self.assertTrue('pizza' in knownWords)
+		self.assertTrue('pizzaz' not in knownWords)
+
+	def testCustomLexicon(self):
+		"""Query expansion should only use the lexicon it was given"""
+		s = snippets.Snipper('', 'dogs', lexicon = lexicon.Lexicon(['dog', 'dogs', 'dogish']))
+		self.assertEqual(sorted(s.buildQueryWordList('dogs')), ['dog', 'dogish', 'dogs'])
+
+		s = snippets.Snipper('', 'dogs', lexicon = lexicon.Lexicon([]))
+		self.assertEqual(s.buildQueryWordList('dogs'), frozenset(['dogs']))
+
+	def testCompiledLexicon(self):
+		"""A compiled lexicon should contain exactly the words it was compiled from"""
+		import words
+		handle, path = tempfile.mkstemp(suffix = '.lex')
+		os.close(handle)
+		try:
+			lexicon.compileLexicon(words.words, path)
+			compiled = lexicon.MappedLexicon(path)
+
+			self.assertEqual(len(compiled), len(set(words.words)))
+			for word in random.sample(words.words, 500):
+				self.assertTrue(word in compiled)
+			for word in ('', 'pizzaz', 'zzzzzz', u'pizzaz', u'\u2603'):
+				self.assertTrue(word not in compiled)
+
+			self.assertTrue(u'pizza' in compiled)
+
+			#iterating gives the words back as words.py has them, sorted bytewise
+			self.assertEqual(list(compiled), sorted(set(words.words),
+					key = lambda word: word.encode('utf-8') if not isinstance(word, bytes) else word))
+
+			s = snippets.Snipper('', 'cherries', lexicon = compiled)
+			self.assertEqual(sorted(s.buildQueryWordList('cherries')),
+					sorted(snippets.Snipper('', 'cherries').buildQueryWordList('cherries')))
+			compiled.close()
+		finally:
+			os.remove(path)
+
+	def testStaleCompiledLexicon(self):
+		"""A compiled lexicon should only be used if it was compiled from the word list as it is now"""
+		handle, path = tempfile.mkstemp(suffix = '.lex')
+		os.close(handle)
+		handle, sourcePath = tempfile.mkstemp(suffix = '.py')
+		os.write(handle, b"words = ['pizza']\n")
+		os.close(handle)
+		try:
+			lexicon.compileLexicon(['pizza'], path, sourcePath)
+			self.assertTrue(isinstance(lexicon.loadLexicon(path, sourcePath), lexicon.MappedLexicon))
+
+			#file times don't matter, only the contents
+			os.utime(path, (0, 0))
+			self.assertTrue(isinstance(lexicon.loadLexicon(path, sourcePath), lexicon.MappedLexicon))
+
+			with open(sourcePath, 'ab') as sourceFile:
+				sourceFile.write(b"words.append('pasta')\n")
+			os.utime(path, None)
+			self.assertTrue(isinstance(lexicon.loadLexicon(path, sourcePath), lexicon.Lexicon))
+
+			#a lexicon which doesn't say where it came from can't be checked
+			lexicon.compileLexicon(['pizza'], path)
+			self.assertTrue(isinstance(lexicon.loadLexicon(path, sourcePath), lexicon.Lexicon))
+
+			#but without the word list there's nothing to check it against
+			os.remove(sourcePath)
+			self.assertTrue(isinstance(lexicon.loadLexicon(path, sourcePath), lexicon.MappedLexicon))
+		finally:
+			os.remove(path)
+			if os.path.exists(sourcePath):
+				os.remove(sourcePath)
+
+class TestLexiconRegistry(unittest.TestCase):
+	"""Tests lazy loading and warm-up of the shared lexicon"""
+	def setUp(self):
+		self.loadCalls = []
+		def loader():
+			self.loadCalls.append(1)
+			return lexicon.Lexicon(['pizza', 'pizzas'])
+		self.registry = lexicon.LexiconRegistry(loader)
+
+	def testLazyLoad(self):
+		"""The lexicon should only be loaded once, on first use"""
+		self.assertFalse(self.registry.loaded)
+		self.assertEqual(self.registry.stats()['loadedAt'], None)
+
+		self.assertTrue('pizza' in self.registry.get())
+		self.registry.get()
+
+		stats = self.registry.stats()
+		self.assertTrue(stats['loaded'])
+		self.assertEqual(stats['loadedBy'], 'lazy')
+		self.assertEqual(stats['loadedInPid'], os.getpid())
+		self.assertEqual(stats['loads'], 1)
+		self.assertEqual(len(self.loadCalls), 1)
+
+	def testWarmup(self):
+		"""Warming up should load the lexicon so that queries don't have to"""
+		self.registry.warmup()
+		self.assertEqual(self.registry.stats()['loadedBy'], 'warmup')
+		self.assertTrue(self.registry.stats()['loadedAt'] is not None)
+
+		self.registry.get()
+		self.registry.warmup()
+		self.assertEqual(len(self.loadCalls), 1)
+
+		self.registry.reset()
+		self.assertFalse(self.registry.loaded)
+		self.registry.get()
+		self.assertEqual(self.registry.stats()['loads'], 2)
+
+	def testSnippetsWarmup(self):
+		"""snippets.warmup should load the process-wide lexicon"""
+		stats = snippets.warmup()
+		self.assertTrue(stats['loaded'])
+		self.assertTrue(snippets.lexiconStats()['loaded'])
+
+class TestQueryCache(unittest.TestCase):
+	"""Tests the cache of expanded queries"""
+	def setUp(self):
+		self.oldSize = snippets.queryCache.maxSize
+		snippets.queryCache.clear()
+
+	def tearDown(self):
+		snippets.setQueryCacheSize(self.oldSize)
+		snippets.queryCache.clear()
+
+	def testEviction(self):
+		"""The least recently used item should be evicted first"""
+		cache = snippets.LRUCache(maxSize = 2)
+		cache.put('a', 1)
+		cache.put('b', 2)
+		self.assertEqual(cache.get('a'), 1)
+		cache.put('c', 3)
+
+		self.assertEqual(cache.get('b'), None)
+		self.assertEqual(cache.get('a'), 1)
+		self.assertEqual(cache.get('c'), 3)
+		self.assertEqual(cache.stats(),
+				{'size':2, 'maxSize':2, 'hits':3, 'misses':1, 'evictions':1})
+
+		cache.maxSize = 1
+		self.assertEqual(len(cache), 1)
+		self.assertEqual(cache.get('c'), 3)
+
+	def testSharedAcrossSnippers(self):
+		"""Equivalent queries from different snippers should share one expansion"""
+		first = snippets.Snipper('deep dish pizza', 'deep dish pizza')
+		second = snippets.Snipper('deep dish pizza', '  deep  dish\tpizza ')
+		self.assertEqual(first.bestSnippetHighlighted, second.bestSnippetHighlighted)
+		snippets.highlightDoc('deep dish pizza', 'deep dish pizza')
+
+		stats = snippets.queryCacheStats()
+		self.assertEqual(stats['misses'], 1)
+		self.assertEqual(stats['hits'], 2)
+		self.assertEqual(stats['size'], 1)
+
+		expanded = first.buildQueryWordList('deep dish pizza')
+		self.assertTrue('pizzas' in expanded)
+		self.assertEqual(expanded, first.expandQuery('deep dish pizza'))
+
+	def testCustomLexiconBypassesCache(self):
+		"""Snippers with their own lexicon should not share the default expansions"""
+		s = snippets.Snipper('', 'dogs', lexicon = lexicon.Lexicon([]))
+		s.buildQueryWordList('dogs')
+		self.assertEqual(snippets.queryCacheStats()['size'], 0)
+
+	def testDisabled(self):
+		"""A zero size cache should still expand queries"""
+		snippets.setQueryCacheSize(0)
+		s = snippets.Snipper('', 'pizza')
+		self.assertTrue('pizzas' in s.buildQueryWordList('pizza'))
+		self.assertEqual(len(snippets.queryCache), 0)
+
+class TestSnipperCache(unittest.TestCase):
+	"""Tests that snippers reuse their work until their parameters change"""
+	def countCalls(self, snipper, name):
+		calls = []
+		method = getattr(snipper, name)
+		def counted(*args):
+			calls.append(args)
+			return method(*args)
+		setattr(snipper, name, counted)
+		return calls
+
+	def testReuse(self):
+		"""Asking for both snippets should only score the document once"""
+		s = snippets.Snipper("The quick brown fox jumped over a lazy dog.", 'fox', maxWords = 200)
+		matchTableCalls = self.countCalls(s, 'buildMatchTable')
+		windowCalls = self.countCalls(s, 'findBestSnippet')
+
+		self.assertEqual(s.bestSnippet, "The quick brown fox jumped over a lazy dog.")
+		self.assertEqual(s.bestSnippetHighlighted,
+				"The quick brown [[HIGHLIGHT]]fox[[ENDHIGHLIGHT]] jumped over a lazy dog.")
+		self.assertEqual(len(matchTableCalls), 1)
+		self.assertEqual(len(windowCalls), 1)
+
+		#setting the same values again shouldn't throw anything away
+		s.maxWords = 200
+		s.query = 'fox'
+		s.bestSnippet
+		self.assertEqual(len(matchTableCalls), 1)
+
+	def testInvalidation(self):
+		"""Changing a parameter should recompute only what depends on it"""
+		s = snippets.Snipper("This is an irrelevant sentence. This is a relevant sentence.",
+				'relevant', maxWords = 3)
+		tokenizeCalls = self.countCalls(s, 'buildMatchTable')
+		scoreCalls = self.countCalls(s, 'scoreMatchPositions')
+		windowCalls = self.countCalls(s, 'findBestSnippet')
+		self.assertEqual(s.bestSnippet, "is a relevant")
+
+		s.minPreceedingWords = 0
+		self.assertEqual(s.minPreceedingWords, 0)
+		self.assertEqual(s.bestSnippet, "relevant sentence.")
+		self.assertEqual((len(tokenizeCalls), len(scoreCalls), len(windowCalls)), (1, 1, 2))
+
+		#the document isn't tokenized again for another snippet length
+		s.maxWords = 6
+		self.assertEqual(s.bestSnippet, "This is a relevant sentence.")
+		self.assertEqual((len(tokenizeCalls), len(scoreCalls), len(windowCalls)), (1, 2, 3))
+
+		s.query = 'irrelevant'
+		self.assertEqual(s.bestSnippet, "This is an irrelevant sentence.")
+		self.assertEqual((len(tokenizeCalls), len(scoreCalls), len(windowCalls)), (2, 3, 4))
+
+		s.doc = "Nothing irrelevant here."
+		self.assertEqual(s.bestSnippet, "Nothing irrelevant here.")
+		self.assertEqual((len(tokenizeCalls), len(scoreCalls), len(windowCalls)), (3, 4, 5))
+
+	def testSnippetLengths(self):
+		"""Snippets of several lengths should come from one scan, and match fresh snippers"""
+		commandline = open('command.txt').read()
+		for scoring in ('decay', 'coverage', 'window', 'exact'):
+			s = snippets.Snipper(commandline, 'operating system', scoring = scoring)
+			tokenizeCalls = self.countCalls(s, 'buildMatchTable')
+
+			for size in (20, 60, 1, 20):
+				s.maxWords = size
+				expected = snippets.Snipper(commandline, 'operating system', maxWords = size, scoring = scoring)
+				self.assertEqual(s.bestSnippetHighlighted, expected.bestSnippetHighlighted)
+				self.assertEqual(s.bestSnippets(3), expected.bestSnippets(3))
+			self.assertEqual(len(tokenizeCalls), 1)
+
 def suite():
 	extractionSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestExtraction)
 	highlightSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestHighlights)
+	multipleSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestMultipleSnippets)
+	coverageSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestCoverageScoring)
+	strategySuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestScoringStrategies)
+	tableSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestTokenTable)
+	streamingSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestStreaming)
+	tokenizedSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestTokenizedDocuments)
+	indexSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestSnippetIndex)
+	mappedSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestMappedDocuments)
+	tokenizerSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestTokenizer)
+	lexiconSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestLexicon)
+	registrySuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestLexiconRegistry)
+	cacheSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestQueryCache)
+	snipperCacheSuite = unittest.defaultTestLoader.loadTestsFromTestCase(TestSnipperCache)
 
-	allTests = unittest.TestSuite((extractionSuite, highlightSuite))
+	allTests = unittest.TestSuite((extractionSuite, highlightSuite, multipleSuite, coverageSuite,
+			strategySuite, tableSuite, streamingSuite, tokenizedSuite, indexSuite, mappedSuite,
+			tokenizerSuite, lexiconSuite, registrySuite, cacheSuite, snipperCacheSuite))
 	return allTests
 
 if __name__ == "__main__":
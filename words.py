@@ -1,5 +1,5 @@
 #!/usr/bin/python
-# -*- coding: iso-8859-15 -*-
+# -*- coding: utf-8 -*-
 # this list of words was copied from an ubuntu 10.04 desktop system
 # without bothering to find out which package it came from. some weird
 # licensing may apply.